@@ -0,0 +1,125 @@
+"""
+コールドスタート計測（新しいプロセスで import → 最初のリクエスト → 2回目のリクエスト）
+
+    python bench/coldstart.py                        # scoring / process_past を5回ずつ
+    python bench/coldstart.py --route scoring --runs 10
+    python bench/coldstart.py --warmup               # 最初のリクエスト前に warm_up() を呼ぶ
+    python bench/coldstart.py --root /path/to/old    # 別のチェックアウト（変更前）を計測
+
+上流と AzureOpenAI は run_bench.py と同じスタブを使う。各値はプロセス間の中央値
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# 子プロセスで実行する計測コード
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+import function_app
+import_ms = (time.perf_counter() - t0) * 1000
+
+sys.path.insert(0, {bench!r})
+import run_bench as rb
+pages, client = rb.install_stubs(0, 0)
+horses = function_app.parse_shutuba_page(pages["shutuba"]) if {route!r} != "process_past" else None
+
+warmup_ms = None
+if {warmup!r}:
+    t = time.perf_counter()
+    function_app.warm_up()
+    warmup_ms = (time.perf_counter() - t) * 1000
+
+fn = rb.user_function(getattr(function_app, {route!r}))
+if {route!r} == "process_past":
+    req = rb.http_request(params={{"url": rb.RACE_URL}})
+else:
+    req = rb.http_request(body={{"horses": horses}})
+
+times = []
+for _ in range(2):
+    t = time.perf_counter()
+    res = fn(req)
+    times.append((time.perf_counter() - t) * 1000)
+    assert res.status_code == 200, res.get_body()[:200]
+
+import resource
+peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+print(json.dumps({{
+    "import_ms": import_ms, "warmup_ms": warmup_ms, "first_ms": times[0], "second_ms": times[1],
+    "peak_rss_mb": peak_rss_mb,
+}}))
+"""
+
+
+def run_once(root, route, warmup):
+    code = CHILD.format(root=root, bench=HERE, route=route, warmup=warmup)
+    # run_bench.py と同じくキャッシュを切る（function_app の import 前に設定が要る）
+    env = dict(os.environ)
+    env.setdefault("SUMMARY_CACHE_BACKEND", "none")
+    env.setdefault("HORSE_HISTORY_ENABLED", "0")
+    env.setdefault("PARSE_MEMO_MAX_ENTRIES", "0")
+    for kind in ("PEDIGREE", "RESULTS", "SHUTUBA", "RACE_LIST"):
+        env.setdefault(f"PAGE_TTL_{kind}", "0")
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, env=env, cwd=root, check=True
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["process_ms"] = wall_ms
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="keiba-ai-api cold start benchmark")
+    parser.add_argument("--root", default=ROOT, help="計測する function_app.py のあるディレクトリ")
+    parser.add_argument("--route", action="append", help="scoring / ranking / process_past（複数可）")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", action="store_true")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    routes = args.route or ["scoring", "process_past"]
+
+    # 1回目は .pyc 作成が入るので捨てる
+    run_once(root, routes[0], args.warmup)
+
+    results = {}
+    for route in routes:
+        runs = [run_once(root, route, args.warmup) for _ in range(args.runs)]
+        results[route] = {
+            key: round(statistics.median(r[key] for r in runs), 1)
+            for key in ("import_ms", "warmup_ms", "first_ms", "second_ms", "process_ms", "peak_rss_mb")
+            if runs[0][key] is not None
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return 0
+
+    print(f"root: {root}  runs: {args.runs}  warmup: {args.warmup}")
+    print(
+        f"{'route':16} {'import ms':>10} {'warmup ms':>10} {'1st req ms':>11} "
+        f"{'2nd req ms':>11} {'process ms':>11} {'peak RSS MB':>12}"
+    )
+    for route, r in results.items():
+        print(
+            f"{route:16} {r['import_ms']:>10} {r.get('warmup_ms', '-'):>10} "
+            f"{r['first_ms']:>11} {r['second_ms']:>11} {r['process_ms']:>11} {r['peak_rss_mb']:>12}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+netkeiba から実ページを取得して bench/fixtures を作り直す
+
+    python bench/record_fixtures.py 202605040811
+
+出馬表（shutuba_past）と、先頭の馬の過去走（ajax_horse_results）・血統ページを保存する
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import function_app as fa  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def save(name, body):
+    path = os.path.join(FIXTURES, name)
+    with open(path, "wb") as f:
+        f.write(body)
+    print(f"saved {path} ({len(body)} bytes)")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python bench/record_fixtures.py <race_id>")
+        return 2
+
+    race_id = sys.argv[1]
+    os.makedirs(FIXTURES, exist_ok=True)
+
+    shutuba = fa.upstream_get(fa.SHUTUBA_URL.format(race_id=race_id)).content
+    save("shutuba_past.html", shutuba)
+
+    horses = fa.parse_shutuba_page(shutuba, with_links=True)
+    if not horses:
+        print("出馬表から馬を取得できませんでした")
+        return 1
+
+    horse_id = horses[0]["horse_id"]
+    save(
+        "ajax_horse_results.html",
+        fa.upstream_get(f"https://db.netkeiba.com/horse/ajax_horse_results.html?id={horse_id}").content,
+    )
+    save("pedigree.html", fa.upstream_get(f"https://db.netkeiba.com/horse/ped/{horse_id}/").content)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+オフライン性能ベンチマーク（bench/fixtures の HTML と AzureOpenAI スタブを使う）
+
+    python bench/run_bench.py                  # 計測して bench/baseline.json と比較
+    python bench/run_bench.py --save-baseline  # 今回の結果を基準として保存
+    python bench/run_bench.py --only parse     # 名前に parse を含むケースだけ
+
+基準より p50 / ピークメモリが許容幅を超えて悪化したケースがあれば終了コード 1、
+基準ファイルがなければ終了コード 2（基準は計測するマシンごとに作る）
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FIXTURES = os.path.join(HERE, "fixtures")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+# 毎回同じ処理量になるようにキャッシュは切っておく
+os.environ.setdefault("SUMMARY_CACHE_BACKEND", "none")
+os.environ.setdefault("HORSE_HISTORY_ENABLED", "0")
+os.environ.setdefault("PARSE_MEMO_MAX_ENTRIES", "0")
+for _kind in ("PEDIGREE", "RESULTS", "SHUTUBA", "RACE_LIST", "ODDS"):
+    os.environ.setdefault(f"PAGE_TTL_{_kind}", "0")
+# スタブ相手なのでレート制限で待たされないようにする
+os.environ.setdefault("LLM_RPM", "1000000")
+os.environ.setdefault("LLM_TPM", "1000000000")
+
+sys.path.insert(0, ROOT)
+
+import azure.functions as func  # noqa: E402
+import function_app as fa  # noqa: E402
+
+RACE_URL = "https://race.netkeiba.com/race/shutuba_past.html?race_id=202605040811"
+
+STUB_SUMMARY = json.dumps(
+    {
+        "strong": "平均着差が小さい",
+        "weak": "上がりが平凡",
+        "reason": "平均着差・ペース安定性が良好",
+        "suitability": "芝マイル向き",
+    },
+    ensure_ascii=False,
+)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+# =========================================================
+# スタブ（netkeiba / AzureOpenAI）
+# =========================================================
+class StubResponse:
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+        self.headers = {}
+
+
+class StubCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, model, messages, temperature, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        content = STUB_SUMMARY
+        # まとめ要約のプロンプトには horse_id ごとの行がある
+        horse_ids = re.findall(r'^\{"horse_id": "(\w+)", "data"', messages[-1]["content"], re.M)
+        if horse_ids:
+            content = "{" + ", ".join(f'"{i}": {STUB_SUMMARY}' for i in horse_ids) + "}"
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class StubOpenAI:
+    def __init__(self, latency):
+        self.chat = SimpleNamespace(completions=StubCompletions(latency))
+
+
+def install_stubs(upstream_latency, llm_latency):
+    pages = {
+        "shutuba": load_fixture("shutuba_past.html"),
+        "results": load_fixture("ajax_horse_results.html"),
+        "pedigree": load_fixture("pedigree.html"),
+    }
+
+    def stub_upstream_get(url, timeout=10, **kwargs):
+        if upstream_latency:
+            time.sleep(upstream_latency)
+        if "ajax_horse_results" in url:
+            return StubResponse(pages["results"])
+        if "/horse/ped/" in url:
+            return StubResponse(pages["pedigree"])
+        return StubResponse(pages["shutuba"])
+
+    client = StubOpenAI(llm_latency)
+    fa.upstream_get = stub_upstream_get
+    fa.get_openai_client = lambda: (client, None)
+    return pages, client
+
+
+def user_function(route):
+    return route._function.get_user_function()
+
+
+def http_request(params=None, body=None):
+    return func.HttpRequest(
+        method="POST" if body is not None else "GET",
+        url="http://localhost/api/bench",
+        params=params or {},
+        body=json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b"",
+    )
+
+
+# =========================================================
+# ベンチマークケース
+# =========================================================
+def build_cases(pages, client):
+    shutuba_table = fa.extract_shutuba_table(pages["shutuba"])
+    horses = fa.parse_shutuba_page(pages["shutuba"])
+    past_html = pages["results"].decode("euc-jp", errors="replace")
+    past_table = fa.extract_past_table_from_ajax(past_html)
+    past_runs = fa.parse_past_5runs_for_condition(past_table)
+    scored = fa.score_horses(horses)
+    race_card, _ = fa.build_race_card("202605040811", RACE_URL)
+
+    scoring = user_function(fa.scoring)
+    ranking = user_function(fa.ranking)
+    score_and_rank = user_function(fa.score_and_rank)
+    process_past = user_function(fa.process_past)
+
+    scoring_req = http_request(body={"horses": horses})
+    ranking_req = http_request(body={"horses": scored})
+    fused_req = http_request(body={"horses": horses, "top_k": 3})
+    process_req = http_request(params={"url": RACE_URL})
+
+    # 同時に8件の解析（PARSE_PROCESSES を設定するとプロセスプールで解析する）
+    parse_threads = ThreadPoolExecutor(max_workers=8)
+
+    def run_parallel_parse():
+        list(parse_threads.map(lambda b: fa.run_parser(fa.parse_past_runs_page, b), [pages["results"]] * 8))
+
+    def run_process_past():
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = process_past(process_req)
+        assert res.status_code == 200, res.get_body()[:200]
+
+    # (名前, 関数, 1回あたりの処理件数, 反復回数の倍率)
+    return [
+        ("extract_shutuba_table", lambda: fa.extract_shutuba_table(pages["shutuba"]), 1, 1.0),
+        ("parse_shutuba_table", lambda: fa.parse_shutuba_table(shutuba_table), 1, 1.0),
+        ("parse_shutuba_page", lambda: fa.parse_shutuba_page(pages["shutuba"]), 1, 1.0),
+        ("extract_past_table_from_ajax", lambda: fa.extract_past_table_from_ajax(past_html), 1, 1.0),
+        ("parse_past_5runs", lambda: fa.parse_past_5runs(past_table), 1, 1.0),
+        ("parse_past_5runs_for_condition", lambda: fa.parse_past_5runs_for_condition(past_table), 1, 1.0),
+        ("extract_features_ajax", lambda: fa.extract_features_ajax(past_runs), 1, 1.0),
+        ("fetch_pedigree", lambda: fa.fetch_pedigree("2019100001"), 1, 1.0),
+        ("generate_summary", lambda: fa.generate_summary(client, json.dumps(horses[0], ensure_ascii=False)), 1, 1.0),
+        ("scoring_handler", lambda: scoring(scoring_req), len(horses), 1.0),
+        ("ranking_handler", lambda: ranking(ranking_req), len(horses), 1.0),
+        ("score_and_rank_handler", lambda: score_and_rank(fused_req), len(horses), 1.0),
+        ("refresh_race_odds", lambda: fa.refresh_race_odds(race_card), len(horses), 1.0),
+        ("parse_past_runs_x8_threads", run_parallel_parse, 8, 0.25),
+        ("process_past_e2e", run_process_past, len(horses), 0.05),
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # メモリは計測のオーバーヘッドがあるので時間計測とは別に1回だけ測る
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": round(iterations / sum(times), 2) if sum(times) else 0.0,
+        "p50_ms": round(percentile(times, 50) * 1000, 3),
+        "p95_ms": round(percentile(times, 95) * 1000, 3),
+        "p99_ms": round(percentile(times, 99) * 1000, 3),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, tolerance, mem_tolerance):
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if r["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50_ms']}ms -> {r['p50_ms']}ms")
+        if r["peak_kb"] > base["peak_kb"] * (1 + mem_tolerance):
+            regressions.append(f"{name}: peak {base['peak_kb']}KB -> {r['peak_kb']}KB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="keiba-ai-api offline benchmark")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--only", default=None, help="名前にこの文字列を含むケースだけ実行")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="p50 の許容悪化率")
+    parser.add_argument("--mem-tolerance", type=float, default=0.25, help="ピークメモリの許容悪化率")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args()
+
+    pages, client = install_stubs(args.upstream_latency_ms / 1000, args.llm_latency_ms / 1000)
+    cases = build_cases(pages, client)
+
+    results = {}
+    for name, fn, items, scale in cases:
+        if args.only and args.only not in name:
+            continue
+        iterations = max(3, int(args.iterations * scale))
+        r = measure(fn, iterations, args.warmup if scale >= 1 else 1)
+        r["items_per_sec"] = round(r["ops_per_sec"] * items, 2)
+        results[name] = r
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        print(f"{'case':32} {'ops/s':>10} {'items/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>9}")
+        for name, r in results.items():
+            print(
+                f"{name:32} {r['ops_per_sec']:>10} {r['items_per_sec']:>10} "
+                f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['peak_kb']:>9}"
+            )
+        print(f"\nprocess peak RSS: {fa.peak_rss_mb()} MB")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        # 比較できないまま成功扱いにすると悪化を見逃すので失敗にする
+        print(f"baseline がありません: {args.baseline}（この環境で --save-baseline を付けて作成）")
+        return 2
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance, args.mem_tolerance)
+    if regressions:
+        print("\nREGRESSIONS:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+
+    print("\nOK: 基準からの悪化なし")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
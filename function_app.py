@@ -1,17 +1,735 @@
 import azure.functions as func
 import logging
 import json
-import requests
-from bs4 import BeautifulSoup
 import re
 import os
+import time
+import hashlib
+import heapq
+import sqlite3
+import threading
+import multiprocessing
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict
 
+# numpy / requests / bs4 / lxml / openai は使う関数の中で import する
+# （コールドスタート時のモジュール読み込みを軽くするため。2回目以降は sys.modules から取るだけ）
+
 # =========================================================
 # Azure Functions v2 FunctionApp（1つだけ）
 # =========================================================
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+# =========================================================
+# 共通：並列実行の設定
+# =========================================================
+# process_past で同時に処理する馬の数
+PROCESS_PAST_MAX_WORKERS = int(os.environ.get("PROCESS_PAST_MAX_WORKERS", "6"))
+# 1ホストあたりの同時リクエスト数の上限（netkeiba への負荷対策）
+UPSTREAM_MAX_PER_HOST = int(os.environ.get("UPSTREAM_MAX_PER_HOST", "4"))
+
+# 失敗時のリトライ回数と待ち時間（指数バックオフ + ジッター）
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", "0.5"))
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def host_semaphore(url: str):
+    host = urlparse(url).netloc
+    with _host_semaphores_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(max(1, UPSTREAM_MAX_PER_HOST))
+            _host_semaphores[host] = sem
+        return sem
+
+# =========================================================
+# 共通：処理時間の計測（span）とメトリクス
+# =========================================================
+# 0 にすると span は何もしない（計測・集計のコストなし）
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") == "1"
+# ステージごとに直近何件の処理時間を保持するか
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", "1024"))
+# ヒストグラムの区切り（ミリ秒）
+METRICS_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Metrics:
+    def __init__(self, window: int):
+        self.window = window
+        self.lock = threading.Lock()
+        self.durations = {}  # stage -> deque（直近の秒数）
+        self.totals = {}  # stage -> [件数, エラー件数]
+        self.counters = {}
+
+    def record(self, stage: str, seconds: float, error: bool = False):
+        with self.lock:
+            d = self.durations.get(stage)
+            if d is None:
+                d = self.durations[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0]
+            d.append(seconds)
+            self.totals[stage][0] += 1
+            if error:
+                self.totals[stage][1] += 1
+
+    def incr(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            durations = {k: sorted(v) for k, v in self.durations.items()}
+            totals = {k: list(v) for k, v in self.totals.items()}
+            counters = dict(self.counters)
+
+        stages = {}
+        for stage, values in durations.items():
+            ms = [v * 1000 for v in values]
+            buckets = {}
+            i = 0
+            for edge in METRICS_BUCKETS_MS:
+                start = i
+                while i < len(ms) and ms[i] <= edge:
+                    i += 1
+                buckets[f"le_{edge}"] = i - start
+            buckets["gt_max"] = len(ms) - i
+
+            def pct(p):
+                return round(ms[min(len(ms) - 1, int(p / 100 * len(ms)))], 2) if ms else None
+
+            stages[stage] = {
+                "count": totals[stage][0],
+                "errors": totals[stage][1],
+                "window": len(ms),
+                "p50_ms": pct(50),
+                "p95_ms": pct(95),
+                "p99_ms": pct(99),
+                "max_ms": round(ms[-1], 2) if ms else None,
+                "histogram_ms": buckets,
+            }
+        return {"stages": stages, "counters": counters}
+
+
+metrics = Metrics(METRICS_WINDOW)
+
+
+class Span:
+    __slots__ = ("stage", "tags", "start")
+
+    def __init__(self, stage, tags):
+        self.stage = stage
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        metrics.record(self.stage, seconds, error=exc_type is not None)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            tags = " ".join(f"{k}={v}" for k, v in self.tags.items())
+            logging.debug(f"span {self.stage} {seconds * 1000:.1f}ms {tags}")
+        return False
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(stage: str, **tags):
+    """
+    with span("llm", race_id=..., horse_id=...): のように使う
+    """
+    if not TRACE_ENABLED:
+        return NOOP_SPAN
+    return Span(stage, tags)
+
+# =========================================================
+# 共通：同じキーの同時処理を1回にまとめる（single-flight）
+# =========================================================
+# 0 にすると呼び出しごとに処理する
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、後から来た呼び出しは実行せずにその結果（例外も）を共有する
+    結果は保持しない（終わった後の再利用は各キャッシュの役目）
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}  # key -> Future
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        if not SINGLE_FLIGHT_ENABLED:
+            return fn(*args, **kwargs)
+
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            metrics.incr(f"single_flight.{self.name}.shared")
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"inflight": len(self.calls), "leaders": self.leaders, "shared": self.shared}
+
+
+page_flight = SingleFlight("page")
+shutuba_flight = SingleFlight("shutuba")
+race_horses_flight = SingleFlight("race_horses")
+past_report_flight = SingleFlight("past_report")
+horse_history_flight = SingleFlight("horse_history")
+pedigree_flight = SingleFlight("pedigree")
+odds_flight = SingleFlight("odds")
+SINGLE_FLIGHTS = (
+    page_flight,
+    shutuba_flight,
+    race_horses_flight,
+    past_report_flight,
+    horse_history_flight,
+    pedigree_flight,
+    odds_flight,
+)
+
+# =========================================================
+# 共通：メモリ（RSS）の上限
+# =========================================================
+# RSS がこれを超えている間は新しいレポート作成を 503 で断る（MB。0 で無効）
+MEMORY_SOFT_LIMIT_MB = int(os.environ.get("MEMORY_SOFT_LIMIT_MB", "1024"))
+MEMORY_RETRY_AFTER = int(os.environ.get("MEMORY_RETRY_AFTER", "10"))
+
+
+def current_rss_mb():
+    # /proc が無い環境では None（制限しない）
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux の ru_maxrss は KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def memory_available():
+    """
+    RSS が上限未満なら True。超えていれば GC してから測り直す
+    """
+    if MEMORY_SOFT_LIMIT_MB <= 0:
+        return True
+
+    rss = current_rss_mb()
+    if rss is None or rss < MEMORY_SOFT_LIMIT_MB:
+        return True
+
+    import gc
+
+    gc.collect()
+    rss = current_rss_mb()
+    if rss < MEMORY_SOFT_LIMIT_MB:
+        return True
+
+    metrics.incr("memory.rejected")
+    logging.warning(f"RSS {rss}MB が上限 {MEMORY_SOFT_LIMIT_MB}MB を超えているためリクエストを断ります")
+    return False
+
+
+MEMORY_BUSY_MESSAGE = "メモリ使用量が上限に近いため受け付けられません。しばらくしてから再実行してください"
+
+
+def memory_busy_response():
+    return func.HttpResponse(
+        MEMORY_BUSY_MESSAGE,
+        status_code=503,
+        headers={"Retry-After": str(MEMORY_RETRY_AFTER)},
+    )
+
+# =========================================================
+# 共通：HTTP セッション（ホストごとに keep-alive で使い回す）
+# =========================================================
+BROWSER_UA = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/120.0.0.0 Safari/537.36"
+)
+
+# 全ホスト共通ヘッダー（Accept-Encoding は get_session で urllib3 が対応しているものだけ足す）
+DEFAULT_HEADERS = {
+    "User-Agent": BROWSER_UA,
+    "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
+}
+
+# ホストごとの追加ヘッダー
+HOST_HEADERS = {
+    "race.netkeiba.com": {
+        "Referer": "https://race.netkeiba.com/",
+    },
+    "db.netkeiba.com": {
+        "Referer": "https://db.netkeiba.com/",
+        "Cookie": "device=pc",
+    },
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(host: str):
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util import Retry, make_headers
+
+            retry = Retry(
+                total=UPSTREAM_RETRIES,
+                backoff_factor=UPSTREAM_BACKOFF,
+                backoff_jitter=UPSTREAM_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max(1, UPSTREAM_MAX_PER_HOST),
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(DEFAULT_HEADERS)
+            session.headers.update(make_headers(accept_encoding=True))
+            session.headers.update(HOST_HEADERS.get(host, {}))
+            _sessions[host] = session
+        return session
+
+
+# 負荷試験などで上流ホストを別の URL に向ける
+# 例: "race.netkeiba.com=http://127.0.0.1:18080,db.netkeiba.com=http://127.0.0.1:18080"
+UPSTREAM_OVERRIDES = dict(
+    item.strip().split("=", 1)
+    for item in os.environ.get("UPSTREAM_OVERRIDES", "").split(",")
+    if "=" in item
+)
+
+
+def upstream_target(url: str):
+    """
+    UPSTREAM_OVERRIDES に該当するホストならスキーム・ホストだけ置き換えた URL を返す
+    キャッシュ・セッション・メトリクスは元のホストのまま扱う
+    """
+    if not UPSTREAM_OVERRIDES:
+        return url
+    parsed = urlparse(url)
+    base = UPSTREAM_OVERRIDES.get(parsed.netloc)
+    if base is None:
+        return url
+    return base.rstrip("/") + url[len(f"{parsed.scheme}://{parsed.netloc}"):]
+
+
+def upstream_get(url: str, timeout=10, **kwargs):
+    """
+    上流（netkeiba）への GET は必ずここを通す
+    ホスト別セッションで接続を再利用し、同時実行数を制限する
+    """
+    import requests
+
+    host = urlparse(url).netloc
+    metrics.incr(f"upstream.requests.{host}")
+    try:
+        with host_semaphore(url):
+            res = get_session(host).get(upstream_target(url), timeout=timeout, **kwargs)
+        res.raise_for_status()
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else "http"
+        metrics.incr(f"upstream.errors.{host}.{status}")
+        raise
+    except Exception as e:
+        metrics.incr(f"upstream.errors.{host}.{type(e).__name__}")
+        raise
+    return res
+
+# =========================================================
+# 共通：取得ページのキャッシュ（URL キー / TTL + LRU / 任意でディスク）
+# =========================================================
+# リソース種別ごとの TTL（秒）。0 ならキャッシュしない
+PAGE_TTL = {
+    "pedigree": int(os.environ.get("PAGE_TTL_PEDIGREE", str(7 * 24 * 3600))),
+    "results": int(os.environ.get("PAGE_TTL_RESULTS", str(6 * 3600))),
+    "shutuba": int(os.environ.get("PAGE_TTL_SHUTUBA", "30")),
+    "race_list": int(os.environ.get("PAGE_TTL_RACE_LIST", "600")),
+    # odds_refresh のポーリング用（同じレースへの連続アクセスをまとめる程度）
+    "odds": int(os.environ.get("PAGE_TTL_ODDS", "3")),
+}
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", "512"))
+# 設定するとワーカー再起動後も残るディスク層を使う
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR")
+
+
+# TTL 切れのページは ETag / Last-Modified 付きで問い合わせ、304 なら手元の本文を使う
+PAGE_REVALIDATE = os.environ.get("PAGE_REVALIDATE", "1") == "1"
+
+
+class PageCache:
+    def __init__(self, max_entries: int, disk_dir: str = None):
+        self.max_entries = max(1, max_entries)
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()  # url -> (fetched_at, body, validators)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidated = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, url: str):
+        return os.path.join(self.disk_dir, hashlib.sha256(url.encode()).hexdigest() + ".html")
+
+    def _read_disk(self, url: str):
+        # (fetched_at, body, validators)。無ければ None
+        path = self._disk_path(url)
+        try:
+            fetched_at = os.path.getmtime(path)
+            with open(path, "rb") as f:
+                body = f.read()
+        except OSError:
+            return None
+        try:
+            with open(path + ".json", encoding="utf-8") as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            validators = {}
+        return fetched_at, body, validators
+
+    def get(self, url: str, ttl: int):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and now - entry[0] < ttl:
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return entry[1]
+
+        if self.disk_dir:
+            entry = self._read_disk(url)
+            if entry and now - entry[0] < ttl:
+                self._put_memory(url, *entry)
+                with self.lock:
+                    self.disk_hits += 1
+                return entry[1]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def stale(self, url: str):
+        """
+        TTL 切れでも残っている (body, validators)。再検証用
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(url)
+        if entry is None:
+            return None
+        return entry[1], entry[2]
+
+    def put(self, url: str, body: bytes, validators: dict = None):
+        fetched_at = time.time()
+        validators = validators or {}
+        self._put_memory(url, fetched_at, body, validators)
+
+        if self.disk_dir:
+            path = self._disk_path(url)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                # 古い validators を消してから本文、最後に validators の順で置き換える
+                # （途中で落ちても新しい ETag と古い本文の組にはならず、次回は取り直すだけ）
+                try:
+                    os.remove(path + ".json")
+                except FileNotFoundError:
+                    pass
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+                with open(tmp + ".json", "w", encoding="utf-8") as f:
+                    json.dump(validators, f)
+                os.replace(tmp + ".json", path + ".json")
+            except OSError as e:
+                logging.warning(f"ページキャッシュ書き込みエラー: {e}")
+
+    def touch(self, url: str, body: bytes, validators: dict):
+        """
+        304 で変わっていないと分かったページの取得時刻だけ更新する
+        """
+        self._put_memory(url, time.time(), body, validators)
+        with self.lock:
+            self.revalidated += 1
+
+        if self.disk_dir:
+            try:
+                os.utime(self._disk_path(url))
+            except OSError:
+                pass
+
+    def _put_memory(self, url, fetched_at, body, validators):
+        with self.lock:
+            self.entries[url] = (fetched_at, body, validators)
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "revalidated": self.revalidated,
+            }
+
+
+page_cache = PageCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_DIR)
+
+
+def fetch_page(url: str, kind: str) -> bytes:
+    """
+    kind（pedigree / results / shutuba）ごとの TTL でキャッシュしつつ本文を取得する
+    同じ URL を同時に取りに来た場合は上流へのリクエストを1本にまとめる
+    """
+    ttl = PAGE_TTL.get(kind, 0)
+    if ttl > 0:
+        body = page_cache.get(url, ttl)
+        if body is not None:
+            return body
+
+    return page_flight.do(url, download_page, url, ttl)
+
+
+def download_page(url: str, ttl: int) -> bytes:
+    stale = page_cache.stale(url) if ttl > 0 and PAGE_REVALIDATE else None
+
+    headers = {}
+    if stale is not None:
+        validators = stale[1]
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    if headers:
+        res = upstream_get(url, headers=headers)
+        if res.status_code == 304:
+            metrics.incr("page.not_modified")
+            page_cache.touch(url, stale[0], stale[1])
+            return stale[0]
+    else:
+        res = upstream_get(url)
+
+    body = res.content
+    if ttl > 0:
+        validators = {}
+        if res.headers.get("ETag"):
+            validators["etag"] = res.headers["ETag"]
+        if res.headers.get("Last-Modified"):
+            validators["last_modified"] = res.headers["Last-Modified"]
+        page_cache.put(url, body, validators)
+    return body
+
+# =========================================================
+# 共通：解析のプロセスプール（bs4 / lxml の CPU 処理を GIL の外へ）
+# =========================================================
+# spawn の子プロセスも関数を受け取るときにこのモジュール全体を import する。
+# 子プロセスでは起動時の処理（過去走ストア・sqlite キャッシュのオープン、ウォームアップ、
+# 孫プロセスのプール）を行わない
+# （parent_process() は子プロセスでメインモジュールを読み込んだ後に設定されるので、
+#   先に設定されるプロセス名で判定する）
+IS_PARSE_WORKER = multiprocessing.current_process().name != "MainProcess"
+
+# 解析に使うプロセス数。0 ならスレッド内で解析する（少ない件数ならこの方が速い）
+PARSE_PROCESSES = 0 if IS_PARSE_WORKER else int(os.environ.get("PARSE_PROCESSES", "0"))
+# これより小さいページは受け渡しのコストの方が大きいのでその場で解析する
+PARSE_PROCESS_MIN_BYTES = int(os.environ.get("PARSE_PROCESS_MIN_BYTES", "4096"))
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            import atexit
+            from concurrent.futures import ProcessPoolExecutor
+
+            # fork だとスレッドが握っているロックごと複製されるので spawn で起動する
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            atexit.register(_parse_pool.shutdown, wait=False, cancel_futures=True)
+        return _parse_pool
+
+
+def run_parser(fn, body: bytes, *args):
+    """
+    fn(body, *args) を実行する。プロセスプールが有効なら子プロセスで実行する
+    fn はモジュール直下の関数で、結果は soup ではなく dict / tuple などの軽いデータにすること
+    """
+    if PARSE_PROCESSES <= 0 or len(body) < PARSE_PROCESS_MIN_BYTES:
+        return fn(body, *args)
+
+    from concurrent.futures.process import BrokenProcessPool
+
+    try:
+        future = get_parse_pool().submit(fn, body, *args)
+    except (BrokenProcessPool, RuntimeError) as e:
+        return run_parser_fallback(fn, body, args, e)
+    metrics.incr("parse.pool_tasks")
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        return run_parser_fallback(fn, body, args, e)
+
+
+def warm_parse_worker(_=None):
+    """
+    子プロセス側のウォームアップ（このモジュールと bs4 / lxml の import、XPath のコンパイル）
+    """
+    parse_shutuba_html(b"<table class='Shutuba_Table'><tr></tr></table>")
+    parse_past_runs_page(b"<table><tr><td></td></tr></table>")
+    # すぐ返すと起動済みの1プロセスが全部取ってしまうので、他の子プロセスにも回るよう少し待つ
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def warm_parse_pool():
+    pool = get_parse_pool()
+    pids = set()
+    for _ in range(3):
+        pids.update(pool.map(warm_parse_worker, range(PARSE_PROCESSES)))
+        if len(pids) >= PARSE_PROCESSES:
+            break
+    return len(pids)
+
+
+def run_parser_fallback(fn, body, args, error):
+    global _parse_pool
+
+    # 子プロセスが落ちた場合はプールを作り直すことにして、今回はその場で解析する
+    logging.warning(f"解析プロセスプールのエラー（スレッドで解析）: {error}")
+    metrics.incr("parse.pool_fallbacks")
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+    return fn(body, *args)
+
+# =========================================================
+# 共通：解析結果のメモ（本文のハッシュをキーにする）
+# =========================================================
+# 同じ内容のページを解析し直さないよう、本文のハッシュ → 解析結果を保持する件数（0 で無効）
+PARSE_MEMO_MAX_ENTRIES = int(os.environ.get("PARSE_MEMO_MAX_ENTRIES", "1024"))
+
+_PARSE_MEMO_MISSING = object()
+
+
+class ParseMemo:
+    """
+    ETag の無いページや TTL 切れで取り直したページでも、内容が同じなら前回の解析結果を返す
+    結果は呼び出し側で共有されるので変更しないこと
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (name, digest, args) -> result
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_parse(self, name: str, body: bytes, fn, *args):
+        if self.max_entries <= 0:
+            return run_parser(fn, body, *args)
+
+        key = (name, hashlib.blake2b(body, digest_size=16).digest(), args)
+        with self.lock:
+            result = self.entries.get(key, _PARSE_MEMO_MISSING)
+            if result is not _PARSE_MEMO_MISSING:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = run_parser(fn, body, *args)
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+parse_memo = ParseMemo(PARSE_MEMO_MAX_ENTRIES)
+
 # =========================================================
 # 共通：race_id 抽出
 # =========================================================
@@ -29,7 +747,22 @@ def extract_race_id(url: str):
 # =========================================================
 # 共通：出馬表（shutuba_past.html）
 # =========================================================
+def dispose_soup(tag):
+    """
+    BeautifulSoup の木は親子・前後の相互参照で循環しており、参照が切れても GC まで残る
+    必要な値を取り出したら木全体を壊してすぐに解放する
+    """
+    if tag is None:
+        return
+    root = tag
+    while root.parent is not None:
+        root = root.parent
+    root.decompose()
+
+
 def extract_shutuba_table(html_bytes: bytes):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_bytes, "lxml")
 
     table = soup.find("table", class_="Shutuba_Table")
@@ -40,6 +773,7 @@ def extract_shutuba_table(html_bytes: bytes):
     if table:
         return table
 
+    soup.decompose()
     return None
 
 
@@ -87,6 +821,37 @@ def parse_shutuba_table(table):
 # =========================================================
 # shutuba 関数
 # =========================================================
+SHUTUBA_URL = "https://race.netkeiba.com/race/shutuba_past.html?race_id={race_id}"
+
+
+def scrape_shutuba(url: str):
+    """
+    出馬表を取得・解析して ({"race_id", "horses"}, err) を返す
+    """
+    race_id = extract_race_id(url)
+    if not race_id:
+        return None, "race_id を URL から抽出できません"
+
+    # 同じページの取得・解析が実行中ならその結果を使う
+    # （shutuba.html と shutuba_past.html は別物なので race_id だけでは束ねない）
+    return shutuba_flight.do((race_id, url), scrape_shutuba_race, url, race_id)
+
+
+def scrape_shutuba_race(url: str, race_id: str):
+    try:
+        with span("shutuba_fetch", race_id=race_id):
+            html_bytes = fetch_page(url, "shutuba")
+    except Exception as e:
+        return None, f"HTML 取得エラー: {e}"
+
+    with span("shutuba_parse", race_id=race_id):
+        horses = parse_shutuba_page(html_bytes)
+    if horses is None:
+        return None, "出馬表テーブルが見つかりません"
+
+    return {"race_id": race_id, "horses": horses}, None
+
+
 @app.route(route="shutuba")
 def shutuba(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("shutuba function triggered")
@@ -107,33 +872,317 @@ def shutuba(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-    try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status()
-        html_bytes = res.content
-    except Exception as e:
+    result, err = scrape_shutuba(url)
+    if err:
         return func.HttpResponse(
-            json.dumps({"error": f"HTML 取得エラー: {e}"}, ensure_ascii=False),
+            json.dumps({"error": err}, ensure_ascii=False),
             status_code=500,
             mimetype="application/json"
         )
 
-    table = extract_shutuba_table(html_bytes)
-    if not table:
+    return func.HttpResponse(
+        json.dumps(result, ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+# =========================================================
+# shutuba_batch 関数（複数レースをまとめて取得）
+# =========================================================
+SHUTUBA_BATCH_MAX_RACES = int(os.environ.get("SHUTUBA_BATCH_MAX_RACES", "48"))
+SHUTUBA_BATCH_MAX_WORKERS = int(os.environ.get("SHUTUBA_BATCH_MAX_WORKERS", "8"))
+
+RACE_LIST_URL = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={date}"
+
+# JRA 競馬場コード（race_id の 5〜6 桁目）
+JRA_VENUES = {
+    "札幌": "01", "函館": "02", "福島": "03", "新潟": "04", "東京": "05",
+    "中山": "06", "中京": "07", "京都": "08", "阪神": "09", "小倉": "10",
+}
+
+
+def race_ids_for_date(date: str, venue: str = None):
+    """
+    開催日（YYYYMMDD）のレース一覧から race_id を集める。venue は名前かコード
+    """
+    html = fetch_page(RACE_LIST_URL.format(date=date), "race_list")
+    text = html.decode("utf-8", errors="replace")
+
+    venue_code = JRA_VENUES.get(venue, venue) if venue else None
+
+    race_ids = []
+    for race_id in re.findall(r"race_id=(\d{12})", text):
+        if race_id in race_ids:
+            continue
+        if venue_code and race_id[4:6] != venue_code:
+            continue
+        race_ids.append(race_id)
+    return race_ids
+
+
+def scrape_shutuba_entry(url: str):
+    result, err = scrape_shutuba(url)
+    if err:
+        return {"race_id": extract_race_id(url), "url": url, "error": err}
+    return {**result, "url": url}
+
+
+@app.route(route="shutuba_batch", methods=[func.HttpMethod.POST])
+def shutuba_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("shutuba_batch function triggered")
+
+    try:
+        body = req.get_json()
+    except:
+        return func.HttpResponse(
+            json.dumps({"error": "JSON ボディが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    urls = list(body.get("urls") or [])
+    urls += [SHUTUBA_URL.format(race_id=r) for r in body.get("race_ids") or []]
+
+    if body.get("date"):
+        try:
+            race_ids = race_ids_for_date(str(body["date"]), body.get("venue"))
+        except Exception as e:
+            return func.HttpResponse(
+                json.dumps({"error": f"レース一覧取得エラー: {e}"}, ensure_ascii=False),
+                status_code=500,
+                mimetype="application/json"
+            )
+        urls += [SHUTUBA_URL.format(race_id=r) for r in race_ids]
+
+    if not urls:
+        return func.HttpResponse(
+            json.dumps({"error": "urls / race_ids / date のいずれかが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    if len(urls) > SHUTUBA_BATCH_MAX_RACES:
         return func.HttpResponse(
-            json.dumps({"error": "出馬表テーブルが見つかりません"}, ensure_ascii=False),
-            status_code=500,
+            json.dumps({"error": f"一度に取得できるのは {SHUTUBA_BATCH_MAX_RACES} レースまでです"}, ensure_ascii=False),
+            status_code=400,
             mimetype="application/json"
         )
 
-    horses = parse_shutuba_table(table)
+    workers = max(1, min(SHUTUBA_BATCH_MAX_WORKERS, len(urls)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        races = list(executor.map(scrape_shutuba_entry, urls))
 
     return func.HttpResponse(
-        json.dumps({"race_id": race_id, "horses": horses}, ensure_ascii=False),
+        json.dumps(
+            {
+                "races": races,
+                "count": len(races),
+                "errors": sum(1 for r in races if "error" in r),
+            },
+            ensure_ascii=False,
+        ),
         mimetype="application/json"
     )
 
+# =========================================================
+# 共通：スコア計算エンジン（馬ごとの値を列にまとめて一括計算）
+# =========================================================
+# 騎手の加点・各項目の係数は scoring_rules.json に置き、更新されたら読み直す
+# 各項目の加点は max(floor, base - (値 - pivot) * slope)
+SCORING_RULES_PATH = os.environ.get(
+    "SCORING_RULES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "scoring_rules.json"),
+)
+SCORING_RULES_CHECK_INTERVAL = float(os.environ.get("SCORING_RULES_CHECK_INTERVAL", "5"))
+
+# 加点を足す順序（結果の丸めを従来と揃えるため固定）
+TERM_FIELDS = ("waku", "weight", "odds", "umaban")
+
+
+class CompiledStage:
+    """
+    scoring / ranking 1段分のルールをコンパイルしたもの
+    """
+
+    def __init__(self, rules: dict):
+        import numpy as np
+
+        terms = rules.get("terms", {})
+        self.active = np.array([f in terms for f in TERM_FIELDS])
+        self.base = np.array([float(terms.get(f, {}).get("base", 0)) for f in TERM_FIELDS])
+        self.pivot = np.array([float(terms.get(f, {}).get("pivot", 0)) for f in TERM_FIELDS])
+        self.slope = np.array([float(terms.get(f, {}).get("slope", 0)) for f in TERM_FIELDS])
+        self.floor = np.array([float(terms.get(f, {}).get("floor", 0)) for f in TERM_FIELDS])
+        self.clamp = rules.get("clamp")
+
+        # 騎手名は全パターンを1本の正規表現にまとめる
+        # 同じ位置で複数一致したら先に書いたものが勝つので、全位置の一致から最優先を選ぶ
+        jockey = rules.get("jockey", {})
+        self.jockey_keys = list(jockey)
+        self.jockey_values = [jockey[k] for k in self.jockey_keys]
+        self.jockey_priority = {k: i for i, k in enumerate(self.jockey_keys)}
+        self.jockey_pattern = None
+        if self.jockey_keys:
+            alternation = "|".join(re.escape(k) for k in self.jockey_keys)
+            self.jockey_pattern = re.compile(f"(?=({alternation}))")
+        self.jockey_memo = {}
+
+    def jockey_bonus(self, names):
+        import numpy as np
+
+        memo = self.jockey_memo
+        if len(memo) > 10000:
+            memo.clear()
+
+        out = np.zeros(len(names))
+        for i, name in enumerate(names):
+            val = memo.get(name)
+            if val is None:
+                val = 0
+                if self.jockey_pattern is not None:
+                    hits = [self.jockey_priority[m.group(1)] for m in self.jockey_pattern.finditer(name)]
+                    if hits:
+                        val = self.jockey_values[min(hits)]
+                memo[name] = val
+            out[i] = val
+        return out
+
+    def evaluate(self, cols, start):
+        import numpy as np
+
+        # (馬数, 項目数) の行列で全項目の加点を一度に計算する
+        x = np.column_stack([cols.waku, cols.weight, cols.odds, cols.umaban])
+        points = np.maximum(self.floor, self.base - (np.nan_to_num(x) - self.pivot) * self.slope)
+        points = np.where(np.isnan(x) | ~self.active, 0.0, points)
+
+        total = start + points[:, 0]
+        total += self.jockey_bonus(cols.jockey)
+        for j in range(1, len(TERM_FIELDS)):
+            total += points[:, j]
+        return total
+
+
+_scoring_rules = None
+_scoring_rules_mtime = None
+_scoring_rules_checked_at = 0.0
+_scoring_rules_lock = threading.Lock()
+
+
+def get_scoring_rules():
+    """
+    {"scoring": CompiledStage, "ranking": CompiledStage} を返す
+    ファイルの更新時刻が変わっていたら読み直す（再デプロイ不要）
+    """
+    global _scoring_rules, _scoring_rules_mtime, _scoring_rules_checked_at
+
+    now = time.time()
+    if _scoring_rules is not None and now - _scoring_rules_checked_at < SCORING_RULES_CHECK_INTERVAL:
+        return _scoring_rules
+
+    with _scoring_rules_lock:
+        _scoring_rules_checked_at = now
+        try:
+            mtime = os.path.getmtime(SCORING_RULES_PATH)
+            if _scoring_rules is None or mtime != _scoring_rules_mtime:
+                with open(SCORING_RULES_PATH, encoding="utf-8") as f:
+                    raw = json.load(f)
+                _scoring_rules = {
+                    "scoring": CompiledStage(raw["scoring"]),
+                    "ranking": CompiledStage(raw["ranking"]),
+                }
+                _scoring_rules_mtime = mtime
+                logging.info(f"スコア設定を読み込みました: {SCORING_RULES_PATH}")
+        except Exception as e:
+            # 読み込みに失敗したら前回のルールを使い続ける
+            if _scoring_rules is None:
+                raise
+            logging.warning(f"スコア設定の再読み込みに失敗しました: {e}")
+
+    return _scoring_rules
+
+
+class HorseColumns:
+    """
+    horses（dict のリスト）を数値列にしたもの。解析できない値は NaN
+    """
+    __slots__ = ("horses", "waku", "umaban", "weight", "odds", "jockey", "score")
+
+    def __init__(self, horses):
+        self.horses = horses
+        nan = float("nan")
+        waku, umaban, weight, odds, score, jockey = [], [], [], [], [], []
+
+        for h in horses:
+            try:
+                waku.append(int(h.get("waku", 0)))
+            except:
+                waku.append(nan)
+            try:
+                umaban.append(int(h.get("umaban", 0)))
+            except:
+                umaban.append(nan)
+            try:
+                weight.append(float(h.get("weight", "0").replace("kg", "").strip()))
+            except:
+                weight.append(nan)
+            o = h.get("odds")
+            try:
+                odds.append(float(o) if o else nan)
+            except:
+                odds.append(nan)
+            try:
+                score.append(float(h.get("score", 0)))
+            except:
+                score.append(0.0)
+            jockey.append(h.get("jockey", "") or "")
+
+        import numpy as np
+
+        self.waku = np.array(waku, dtype=float)
+        self.umaban = np.array(umaban, dtype=float)
+        self.weight = np.array(weight, dtype=float)
+        self.odds = np.array(odds, dtype=float)
+        self.score = np.array(score, dtype=float)
+        self.jockey = jockey
+
+
+def score_columns(cols: HorseColumns, rules=None):
+    import numpy as np
+
+    stage = (rules or get_scoring_rules())["scoring"]
+    score = stage.evaluate(cols, np.zeros(len(cols.horses)))
+    # round は Python の round と揃える
+    if stage.clamp:
+        low, high = stage.clamp
+        return [max(low, min(high, round(v, 2))) for v in score.tolist()]
+    return [round(v, 2) for v in score.tolist()]
+
+
+def ranking_columns(cols: HorseColumns, rules=None):
+    stage = (rules or get_scoring_rules())["ranking"]
+    total = stage.evaluate(cols, cols.score)
+    return [round(v, 2) for v in total.tolist()]
+
+
+def score_horses(horses):
+    scores = score_columns(HorseColumns(horses))
+    return [{**h, "score": s} for h, s in zip(horses, scores)]
+
+
+def rank_horses(horses):
+    totals = ranking_columns(HorseColumns(horses))
+    ranked = [{**h, "ranking_score": t} for h, t in zip(horses, totals)]
+    return sorted(ranked, key=lambda x: x["ranking_score"], reverse=True)
+
+
+def split_races(values, races):
+    out = []
+    start = 0
+    for race in races:
+        end = start + len(race["horses"])
+        out.append(values[start:end])
+        start = end
+    return out
+
 # =========================================================
 # scoring 関数
 # =========================================================
@@ -158,55 +1207,7 @@ def scoring(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-    scored = []
-
-    for h in horses:
-        score = 0
-
-        # 枠順
-        try:
-            waku = int(h.get("waku", 0))
-            score += max(5, 25 - waku * 3)
-        except:
-            pass
-
-        # 騎手
-        jockey = h.get("jockey", "")
-        jockey_score_map = {
-            "川田": 25, "ルメール": 25, "戸崎": 20, "横山武": 20,
-            "松山": 18, "坂井": 18, "武豊": 18,
-        }
-        for key, val in jockey_score_map.items():
-            if key in jockey:
-                score += val
-                break
-
-        # 斤量
-        try:
-            weight = float(h.get("weight", "0").replace("kg", "").strip())
-            score += max(0, 20 - (weight - 55) * 1.5)
-        except:
-            pass
-
-        # オッズ
-        odds = h.get("odds")
-        if odds:
-            try:
-                odds_val = float(odds)
-                score += max(0, 30 - odds_val * 2)
-            except:
-                pass
-
-        # 馬番
-        try:
-            umaban = int(h.get("umaban", 0))
-            score += max(0, 15 - umaban * 0.5)
-        except:
-            pass
-
-        score = max(0, min(100, round(score, 2)))
-
-        scored.append({**h, "score": score})
+    scored = score_horses(horses)
 
     return func.HttpResponse(
         json.dumps({"horses": scored}, ensure_ascii=False),
@@ -237,48 +1238,7 @@ def ranking(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-    ranked = []
-
-    for h in horses:
-        total = h.get("score", 0)
-
-        # 枠順補正
-        try:
-            waku = int(h.get("waku", 0))
-            total += max(0, 10 - (waku - 1) * 1.2)
-        except:
-            pass
-
-        # 騎手補正
-        jockey = h.get("jockey", "")
-        jockey_score_map = {
-            "川田": 8, "ルメール": 8, "戸崎": 6, "横山武": 6,
-            "松山": 5, "坂井": 5, "武豊": 5,
-        }
-        for key, val in jockey_score_map.items():
-            if key in jockey:
-                total += val
-                break
-
-        # オッズ補正
-        odds = h.get("odds")
-        if odds:
-            try:
-                odds_val = float(odds)
-                total += max(0, 15 - odds_val * 1.5)
-            except:
-                pass
-
-        # 馬番補正
-        try:
-            umaban = int(h.get("umaban", 0))
-            total += max(0, 8 - umaban * 0.3)
-        except:
-            pass
-
-        ranked.append({**h, "ranking_score": round(total, 2)})
-
-    ranked_sorted = sorted(ranked, key=lambda x: x["ranking_score"], reverse=True)
+    ranked_sorted = rank_horses(horses)
 
     return func.HttpResponse(
         json.dumps({"horses": ranked_sorted}, ensure_ascii=False),
@@ -286,35 +1246,447 @@ def ranking(req: func.HttpRequest) -> func.HttpResponse:
     )
 
 # =========================================================
-# process_past（調子分析 + AI要約）
+# score_and_rank 関数（scoring → ranking を1回で実行）
 # =========================================================
+# compact 指定時に返すフィールド
+COMPACT_FIELDS = ("umaban", "horse_name", "horse_id")
 
-# OpenAI import
-try:
-    from openai import AzureOpenAI
-    openai_import_error = None
-except Exception as e:
-    AzureOpenAI = None
-    openai_import_error = str(e)
 
+def score_and_rank_horses(horses, top_k=None, compact=False):
+    import numpy as np
 
-def get_openai_client():
-    if AzureOpenAI is None:
-        return None, f"OpenAI import エラー: {openai_import_error}"
+    rules = get_scoring_rules()
+    cols = HorseColumns(horses)
+    scores = score_columns(cols, rules)
+
+    # ranking は scoring の結果を土台にするので、解析済みの列をそのまま使う
+    cols.score = np.array(scores, dtype=float)
+    totals = ranking_columns(cols, rules)
+
+    key = totals.__getitem__
+    if top_k is not None and top_k < len(horses):
+        # 全件ソートせず上位 k 件だけ選ぶ（同点の順序は sorted と同じ）
+        order = heapq.nlargest(top_k, range(len(horses)), key=key)
+    else:
+        order = sorted(range(len(horses)), key=key, reverse=True)
+
+    out = []
+    for i in order:
+        h = horses[i]
+        base = {k: h[k] for k in COMPACT_FIELDS if k in h} if compact else h
+        out.append({**base, "score": scores[i], "ranking_score": totals[i]})
+    return out
+
+
+@app.route(route="score_and_rank")
+def score_and_rank(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("score_and_rank function triggered")
 
     try:
-        client = AzureOpenAI(
-            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-            api_version="2024-02-01",
-            azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT")
+        body = req.get_json()
+    except:
+        return func.HttpResponse(
+            json.dumps({"error": "JSON ボディが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
         )
-        return client, None
+
+    horses = body.get("horses")
+    if not horses:
+        return func.HttpResponse(
+            json.dumps({"error": "horses が必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    top_k = body.get("top_k", req.params.get("top_k"))
+    try:
+        top_k = int(top_k) if top_k not in (None, "") else None
+    except (TypeError, ValueError):
+        return func.HttpResponse(
+            json.dumps({"error": "top_k は整数で指定してください"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+    if top_k is not None and top_k < 1:
+        return func.HttpResponse(
+            json.dumps({"error": "top_k は1以上で指定してください"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    compact = body.get("compact", req.params.get("compact"))
+    compact = compact in (True, "1", "true", "True")
+
+    ranked = score_and_rank_horses(horses, top_k=top_k, compact=compact)
+
+    return func.HttpResponse(
+        json.dumps({"horses": ranked}, ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+# =========================================================
+# scoring_batch / ranking_batch 関数（複数レースを一括計算）
+# =========================================================
+def parse_races_body(req: func.HttpRequest):
+    try:
+        body = req.get_json()
+    except:
+        return None, "JSON ボディが必要です"
+
+    races = body.get("races")
+    if not races or not isinstance(races, list):
+        return None, "races が必要です"
+
+    for race in races:
+        if not isinstance(race, dict) or not isinstance(race.get("horses"), list):
+            return None, "races の各要素に horses が必要です"
+
+    return races, None
+
+
+def batch_response(races, key, results):
+    out = [
+        {**{k: v for k, v in race.items() if k != "horses"}, key: res}
+        for race, res in zip(races, results)
+    ]
+    return func.HttpResponse(
+        json.dumps({"races": out}, ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+
+@app.route(route="scoring_batch", methods=[func.HttpMethod.POST])
+def scoring_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("scoring_batch function triggered")
+
+    races, err = parse_races_body(req)
+    if err:
+        return func.HttpResponse(
+            json.dumps({"error": err}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    # 全レースの馬を1つの列にまとめて1回で計算する
+    all_horses = [h for race in races for h in race["horses"]]
+    scores = score_columns(HorseColumns(all_horses))
+
+    results = [
+        [{**h, "score": s} for h, s in zip(race["horses"], race_scores)]
+        for race, race_scores in zip(races, split_races(scores, races))
+    ]
+    return batch_response(races, "horses", results)
+
+
+@app.route(route="ranking_batch", methods=[func.HttpMethod.POST])
+def ranking_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("ranking_batch function triggered")
+
+    races, err = parse_races_body(req)
+    if err:
+        return func.HttpResponse(
+            json.dumps({"error": err}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    all_horses = [h for race in races for h in race["horses"]]
+    totals = ranking_columns(HorseColumns(all_horses))
+
+    results = []
+    for race, race_totals in zip(races, split_races(totals, races)):
+        ranked = [{**h, "ranking_score": t} for h, t in zip(race["horses"], race_totals)]
+        results.append(sorted(ranked, key=lambda x: x["ranking_score"], reverse=True))
+    return batch_response(races, "horses", results)
+
+# =========================================================
+# odds_refresh 関数（オッズだけ取り直して再スコア・順位の差分を返す）
+# =========================================================
+# 出馬表を保持するレース数と保持時間（秒）
+RACE_CARD_MAX_ENTRIES = int(os.environ.get("RACE_CARD_MAX_ENTRIES", "256"))
+RACE_CARD_TTL = int(os.environ.get("RACE_CARD_TTL", str(12 * 3600)))
+
+
+class RaceCard:
+    """
+    解析済みの出馬表と、その時点のスコア・ランキングスコア（更新時は作り直す）
+    """
+
+    __slots__ = ("race_id", "url", "horses", "scores", "totals", "rules", "created_at", "refreshed_at")
+
+    def __init__(self, race_id, url, horses, scores, totals, rules, created_at, refreshed_at):
+        self.race_id = race_id
+        self.url = url
+        self.horses = horses
+        self.scores = scores
+        self.totals = totals
+        self.rules = rules
+        self.created_at = created_at
+        self.refreshed_at = refreshed_at
+
+    def ranks(self):
+        # ranking と同じ並び（ranking_score 降順・同点は出馬表順）での順位
+        order = sorted(range(len(self.horses)), key=self.totals.__getitem__, reverse=True)
+        ranks = [0] * len(order)
+        for pos, i in enumerate(order):
+            ranks[i] = pos + 1
+        return ranks
+
+
+# odds_flight と同じ (race_id, url) をキーにする（URL ごとに別のページ・別の差分として扱う）
+race_cards = OrderedDict()  # (race_id, url) -> RaceCard
+race_cards_lock = threading.Lock()
+
+
+def get_race_card(race_id: str, url: str):
+    key = (race_id, url)
+    with race_cards_lock:
+        card = race_cards.get(key)
+        if card is None:
+            return None
+        if time.time() - card.created_at >= RACE_CARD_TTL:
+            del race_cards[key]
+            return None
+        race_cards.move_to_end(key)
+        return card
+
+
+def put_race_card(card: RaceCard):
+    key = (card.race_id, card.url)
+    with race_cards_lock:
+        race_cards[key] = card
+        race_cards.move_to_end(key)
+        while len(race_cards) > max(1, RACE_CARD_MAX_ENTRIES):
+            race_cards.popitem(last=False)
+
+
+def score_and_rank_columns(horses, rules):
+    """
+    horses の (scores, ranking_scores)。1頭ずつ独立に計算されるので一部の馬だけでもよい
+    """
+    import numpy as np
+
+    cols = HorseColumns(horses)
+    scores = score_columns(cols, rules)
+    cols.score = np.array(scores, dtype=float)
+    return scores, ranking_columns(cols, rules)
+
+
+def build_race_card(race_id: str, url: str):
+    result, err = scrape_shutuba(url)
+    if err:
+        return None, err
+
+    rules = get_scoring_rules()
+    horses = result["horses"]
+    scores, totals = score_and_rank_columns(horses, rules)
+    now = time.time()
+    card = RaceCard(race_id, url, horses, scores, totals, rules, now, now)
+    put_race_card(card)
+    return card, None
+
+
+def lxml_extract_odds(table):
+    """
+    出馬表テーブルから 馬番 -> Odds_Ninki だけを読む（行の判定は lxml_parse_shutuba_table と同じ）
+    """
+    odds = {}
+    for row in XP_ROWS(table)[1:]:
+        cols = XP_CELLS(row)
+        if len(cols) < 10:
+            continue
+        odds_span = XP_ODDS(row)
+        odds[lxml_text(cols[1]).strip()] = lxml_text_strip(odds_span[0]) if odds_span else None
+    return odds
+
+
+def parse_odds_page(html_bytes: bytes):
+    table = lxml_stream_find_table(html_bytes, XP_SHUTUBA_TABLES)
+    return None if table is None else lxml_extract_odds(table)
+
+
+def refresh_race_odds(card: RaceCard):
+    """
+    オッズが変わった馬だけ再計算し ((新しい RaceCard, 再計算した頭数, 変更点), err) を返す
+    """
+    try:
+        with span("odds_fetch", race_id=card.race_id):
+            html_bytes = fetch_page(card.url, "odds")
     except Exception as e:
-        return None, f"OpenAI クライアント初期化エラー: {e}"
+        return None, f"HTML 取得エラー: {e}"
+
+    with span("odds_parse", race_id=card.race_id):
+        latest = parse_memo.get_or_parse("odds", html_bytes, parse_odds_page)
+    if latest is None:
+        return None, "出馬表テーブルが見つかりません"
+
+    rules = get_scoring_rules()
+    horses = list(card.horses)
+    for i, h in enumerate(horses):
+        odds = latest.get(h.get("umaban"), h.get("odds"))
+        if odds != h.get("odds"):
+            horses[i] = {**h, "odds": odds}
+
+    # スコアリングルールが変わっていたら全頭、そうでなければオッズが変わった馬だけ計算し直す
+    if rules is card.rules:
+        targets = [i for i, h in enumerate(horses) if h is not card.horses[i]]
+    else:
+        targets = list(range(len(horses)))
+
+    scores = list(card.scores)
+    totals = list(card.totals)
+    if targets:
+        with span("odds_rescore", race_id=card.race_id):
+            new_scores, new_totals = score_and_rank_columns([horses[i] for i in targets], rules)
+        for i, s, t in zip(targets, new_scores, new_totals):
+            scores[i] = s
+            totals[i] = t
+
+    fresh = RaceCard(card.race_id, card.url, horses, scores, totals, rules, card.created_at, time.time())
+    put_race_card(fresh)
+
+    old_ranks = card.ranks()
+    new_ranks = fresh.ranks()
+    changes = []
+    for i, h in enumerate(horses):
+        old = card.horses[i]
+        if (
+            h is old
+            and scores[i] == card.scores[i]
+            and totals[i] == card.totals[i]
+            and new_ranks[i] == old_ranks[i]
+        ):
+            continue
+        changes.append({
+            "umaban": h.get("umaban"),
+            "horse_name": h.get("horse_name"),
+            "odds": {"old": old.get("odds"), "new": h.get("odds")},
+            "score": {"old": card.scores[i], "new": scores[i]},
+            "ranking_score": {"old": card.totals[i], "new": totals[i]},
+            "rank": {"old": old_ranks[i], "new": new_ranks[i]},
+        })
+
+    metrics.incr("odds_refresh.rescored", len(targets))
+    return (fresh, len(targets), changes), None
+
+
+def ranked_card(card: RaceCard):
+    ranks = card.ranks()
+    order = sorted(range(len(card.horses)), key=ranks.__getitem__)
+    return [
+        {**card.horses[i], "score": card.scores[i], "ranking_score": card.totals[i], "rank": ranks[i]}
+        for i in order
+    ]
+
+
+def odds_refresh_race(race_id: str, url: str):
+    """
+    初回は出馬表を取得して保持、2回目以降はオッズだけ取り直す
+    """
+    card = get_race_card(race_id, url)
+    if card is None:
+        card, err = build_race_card(race_id, url)
+        if err:
+            return None, err
+        return {"card": card, "initial": True, "rescored": len(card.horses), "changes": []}, None
+
+    result, err = refresh_race_odds(card)
+    if err:
+        return None, err
+    card, rescored, changes = result
+    return {"card": card, "initial": False, "rescored": rescored, "changes": changes}, None
+
+
+@app.route(route="odds_refresh", methods=[func.HttpMethod.GET])
+def odds_refresh(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("odds_refresh function triggered")
+
+    race_id = req.params.get("race_id")
+    url = req.params.get("url")
+    if url and not race_id:
+        race_id = extract_race_id(url)
+    if not race_id:
+        return func.HttpResponse(
+            json.dumps({"error": "race_id または url パラメータが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+    url = url or SHUTUBA_URL.format(race_id=race_id)
+
+    # 同じレースを同時にポーリングされても取得・再計算は1回
+    result, err = odds_flight.do((race_id, url), odds_refresh_race, race_id, url)
+    if err:
+        return func.HttpResponse(
+            json.dumps({"error": err}, ensure_ascii=False),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+    card = result["card"]
+    out = {
+        "race_id": race_id,
+        "initial": result["initial"],
+        "rescored": result["rescored"],
+        "changes": result["changes"],
+        "refreshed_at": datetime.fromtimestamp(card.refreshed_at, JST).isoformat(timespec="seconds"),
+    }
+    # 初回と full=1 のときは全頭のランキングも返す
+    if result["initial"] or req.params.get("full") == "1":
+        out["horses"] = ranked_card(card)
+
+    return func.HttpResponse(
+        json.dumps(out, ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+# =========================================================
+# process_past（調子分析 + AI要約）
+# =========================================================
+
+OPENAI_API_VERSION = "2024-02-01"
+LLM_MODEL = "keiba-gpt4omini"
+LLM_TEMPERATURE = 0.4
+
+# クライアントはプロセスで1つだけ作って使い回す（接続プールも共有される）
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    global _openai_client
+
+    client = _openai_client
+    if client is not None:
+        return client, None
+
+    with _openai_client_lock:
+        if _openai_client is not None:
+            return _openai_client, None
+
+        # openai の import は重いので最初に使うときまで遅らせる
+        try:
+            from openai import AzureOpenAI
+        except Exception as e:
+            return None, f"OpenAI import エラー: {e}"
+
+        try:
+            _openai_client = AzureOpenAI(
+                api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+                api_version=OPENAI_API_VERSION,
+                # 429・5xx・接続エラーの再試行は llm_scheduler が行う
+                max_retries=0,
+                azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT")
+            )
+        except Exception as e:
+            return None, f"OpenAI クライアント初期化エラー: {e}"
+        return _openai_client, None
 
 
 # 出馬表（process_past 用）
 def extract_shutuba_table_with_links(html_bytes):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_bytes, "lxml")
 
     table = soup.find("table", class_="RaceTable01 RaceTable01-HorseList")
@@ -329,6 +1701,7 @@ def extract_shutuba_table_with_links(html_bytes):
     if table:
         return table
 
+    soup.decompose()
     return None
 
 
@@ -371,134 +1744,580 @@ def parse_shutuba_table_with_links(table):
     return horses
 
 
-# Ajax 過去走
-def fetch_past_runs_html(horse_id: str):
-    url = f"https://db.netkeiba.com/horse/ajax_horse_results.html?id={horse_id}"
+# =========================================================
+# 共通：出馬表の高速解析（lxml + XPath 直接）
+# =========================================================
+# lxml: XPath で直接解析（既定） / bs4: 従来の BeautifulSoup 解析
+SHUTUBA_PARSER = os.environ.get("SHUTUBA_PARSER", "lxml")
+
+
+def xpath_has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class LazyXPath:
+    """
+    初回の呼び出しでコンパイルする XPath（起動時に lxml を読み込まないため）
+    """
+
+    __slots__ = ("expr", "compiled")
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.compiled = None
+
+    def __call__(self, el):
+        xp = self.compiled
+        if xp is None:
+            from lxml import etree
+
+            xp = self.compiled = etree.XPath(self.expr)
+        return xp(el)
+
+
+# BeautifulSoup の find(class_=...) と同じ順序・条件でテーブルを探す
+XP_SHUTUBA_TABLES = [
+    LazyXPath(f"//table[{xpath_has_class('Shutuba_Table')}]"),
+    LazyXPath("//table[normalize-space(@class)='RaceTable01 RaceTable01-Shutuba']"),
+]
+XP_SHUTUBA_TABLES_WITH_LINKS = [
+    LazyXPath("//table[normalize-space(@class)='RaceTable01 RaceTable01-HorseList']"),
+] + XP_SHUTUBA_TABLES
+
+XP_ROWS = LazyXPath(".//tr")
+XP_CELLS = LazyXPath(".//td")
+XP_HORSE_NAME = LazyXPath(f".//span[{xpath_has_class('HorseName')}]")
+XP_HORSE_LINK = LazyXPath(".//a[contains(@href, '/horse/')]")
+XP_ODDS = LazyXPath(f".//span[{xpath_has_class('Odds_Ninki')}]")
+XP_FIRST_LINK = LazyXPath(".//a")
+XP_FIRST_TABLE = LazyXPath("//table")
+XP_TBODY = LazyXPath(".//tbody")
+# get_text と同じく script / style / template 内の文字は含めない
+XP_TEXT = LazyXPath(".//text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+
+
+def lxml_text(el):
+    # BeautifulSoup の .text 相当
+    return "".join(XP_TEXT(el))
+
+
+def lxml_text_strip(el):
+    # BeautifulSoup の get_text(strip=True) 相当
+    return "".join(t.strip() for t in XP_TEXT(el))
+
+
+def lxml_encoding(html_bytes: bytes):
+    from bs4.dammit import EncodingDetector, UnicodeDammit
+
+    # 文字コードは BeautifulSoup と同じ判定にそろえる（宣言があればそれを使う）
+    encoding = EncodingDetector.find_declared_encoding(html_bytes, is_html=True)
+    if not encoding:
+        encoding = UnicodeDammit(html_bytes, is_html=True).original_encoding
+    return encoding
+
+
+def lxml_document(html_bytes: bytes):
+    from lxml import html as lxml_html
+
+    encoding = lxml_encoding(html_bytes)
+    parser = lxml_html.HTMLParser(encoding=encoding) if encoding else None
+    return lxml_html.document_fromstring(html_bytes, parser=parser)
+
+
+# 逐次解析で1回に渡す量
+LXML_FEED_CHUNK = 16 * 1024
+
+
+def lxml_stream_find_table(data, xpaths):
+    """
+    lxml_find_table(lxml_document(data), xpaths) と同じテーブルを返す
+    少しずつ解析し、xpaths[0] に当たる最初のテーブルが閉じた時点で残りの HTML は読まない
+    data は bytes（文字コードは lxml_document と同じ判定）か str
+    """
+    from lxml import etree
+
+    encoding = lxml_encoding(data) if isinstance(data, bytes) else None
+    parser = etree.HTMLPullParser(events=("end",), tag="table", encoding=encoding)
+    first = xpaths[0]
+    for pos in range(0, len(data), LXML_FEED_CHUNK):
+        parser.feed(data[pos:pos + LXML_FEED_CHUNK])
+        for _, el in parser.read_events():
+            # 途中までの木で文書順の先頭がこのテーブルなら、以降を読んでも答えは変わらない
+            hits = first(el)
+            if hits and hits[0] is el:
+                return el
+    return lxml_find_table(parser.close(), xpaths)
+
+
+def lxml_find_table(doc, xpaths):
+    for xp in xpaths:
+        found = xp(doc)
+        if found:
+            return found[0]
+    return None
+
+
+def lxml_parse_shutuba_table(table):
+    horses = []
+
+    for row in XP_ROWS(table)[1:]:
+        cols = XP_CELLS(row)
+        if len(cols) < 10:
+            continue
+
+        horse_name = ""
+        horse_id = None
+
+        tag = XP_HORSE_NAME(row)
+        if tag:
+            horse_name = lxml_text_strip(tag[0])
+
+        a = XP_HORSE_LINK(row)
+        a = a[0] if a else None
+        if a is not None:
+            m = re.search(r"/horse/(\d+)", a.get("href", ""))
+            if m:
+                horse_id = m.group(1)
+
+        if not horse_name and a is not None:
+            horse_name = lxml_text(a).strip()
+
+        odds_span = XP_ODDS(row)
+        odds = lxml_text_strip(odds_span[0]) if odds_span else None
+
+        horses.append({
+            "waku": lxml_text(cols[0]).strip(),
+            "umaban": lxml_text(cols[1]).strip(),
+            "horse_name": horse_name,
+            "horse_id": horse_id,
+            "sex_age": lxml_text(cols[4]).strip(),
+            "weight": lxml_text(cols[5]).strip(),
+            "jockey": lxml_text(cols[6]).strip(),
+            "odds": odds,
+        })
+
+    return horses
+
+
+def lxml_parse_shutuba_table_with_links(table):
+    horses = []
+
+    for row in XP_ROWS(table)[1:]:
+        cols = XP_CELLS(row)
+        if len(cols) < 3:
+            continue
+
+        waku = lxml_text(cols[0]).strip()
+        umaban = lxml_text(cols[1]).strip()
+
+        if not waku or not waku[0].isdigit():
+            continue
+
+        horse_name = ""
+        horse_id = None
+
+        for c in cols:
+            a = XP_FIRST_LINK(c)
+            if a and "horse" in (a[0].get("href") or ""):
+                horse_name = lxml_text(a[0]).strip()
+                horse_url = a[0].get("href", "")
+                horse_id = horse_url.rstrip("/").split("/")[-1]
+                break
+
+        if not horse_name or not horse_id:
+            continue
+
+        horses.append({
+            "waku": waku,
+            "umaban": umaban,
+            "horse_name": horse_name,
+            "horse_id": horse_id,
+        })
+
+    return horses
+
+
+def parse_shutuba_page(html_bytes: bytes, with_links: bool = False):
+    """
+    出馬表ページ → horses。テーブルが無ければ None
+    前回と同じ内容のページなら解析せずに前回の結果を返す
+    """
+    return parse_memo.get_or_parse("shutuba", html_bytes, parse_shutuba_html, with_links)
+
+
+def parse_shutuba_html(html_bytes: bytes, with_links: bool = False):
+    """
+    lxml で失敗した場合は BeautifulSoup 版で解析し直す
+    """
+    if SHUTUBA_PARSER == "lxml":
+        try:
+            if with_links:
+                table = lxml_stream_find_table(html_bytes, XP_SHUTUBA_TABLES_WITH_LINKS)
+                return None if table is None else lxml_parse_shutuba_table_with_links(table)
+            table = lxml_stream_find_table(html_bytes, XP_SHUTUBA_TABLES)
+            return None if table is None else lxml_parse_shutuba_table(table)
+        except Exception as e:
+            logging.warning(f"lxml 出馬表解析エラー（BeautifulSoup で再解析）: {e}")
+
+    if with_links:
+        table = extract_shutuba_table_with_links(html_bytes)
+        parse = parse_shutuba_table_with_links
+    else:
+        table = extract_shutuba_table(html_bytes)
+        parse = parse_shutuba_table
+    if table is None:
+        return None
     try:
-        headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/120.0.0.0 Safari/537.36"
-            ),
-            "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
-            "Referer": "https://db.netkeiba.com/",
-            "Cookie": "device=pc"
-        }
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status()
+        return parse(table)
+    finally:
+        dispose_soup(table)
 
-        res.encoding = "euc-jp"
 
-        return res.text, None
+# Ajax 過去走
+def fetch_past_runs_page(horse_id: str):
+    url = f"https://db.netkeiba.com/horse/ajax_horse_results.html?id={horse_id}"
+    try:
+        return fetch_page(url, "results"), None
     except Exception as e:
         return None, f"過去走HTML取得エラー: {e}"
 
+
+def fetch_past_runs_html(horse_id: str):
+    body, err = fetch_past_runs_page(horse_id)
+    if err:
+        return None, err
+    return body.decode("euc-jp", errors="replace"), None
+
 def extract_past_table_from_ajax(html_text: str):
     # JSON が返ってきた場合の防御
     if html_text.strip().startswith("{"):
         return None
 
+    from bs4 import BeautifulSoup
+
     # Linux で安定するパーサー
     soup = BeautifulSoup(html_text, "html.parser")
 
     # table が見つからない場合は None
     table = soup.find("table")
+    if table is None:
+        soup.decompose()
     return table
 
 
 # =========================================================
-# ① AI要約用（LLM に渡す軽量データ）
+# 過去走テーブルの読み取り（各 <td> は1回だけ読む）
 # =========================================================
-def parse_past_5runs(table):
-    # ★ table が None の場合は空リスト
+# 何走分を使うか
+PAST_RUNS_WINDOW = int(os.environ.get("PAST_RUNS_WINDOW", "5"))
+# lxml: 最初の table までを逐次解析（既定） / bs4: 従来の html.parser で全体を解析
+PAST_RUNS_PARSER = os.environ.get("PAST_RUNS_PARSER", "lxml")
+
+# ① AI要約用（LLM に渡す軽量データ）の列
+SUMMARY_COLUMNS = (
+    ("date", 0), ("race", 1), ("class", 2), ("distance", 3), ("condition", 4),
+    ("finish", 5), ("time", 7), ("agari", 10), ("passing", 11), ("jockey", 12),
+    ("weight", 13), ("body_weight", 14),
+)
+
+# ② 調子スコア計算用（特徴量抽出のための数値データ）の列
+CONDITION_COLUMNS = (
+    ("date", 0), ("race_name", 4), ("class", 2), ("rank", 11), ("time", 18),
+    ("margin", 19), ("pop", 10), ("agari", 22), ("passing", 21), ("jockey", 12),
+    ("weight", 13), ("distance", 14), ("baba", 16),
+)
+
+
+class PastRuns:
+    """
+    過去走テーブルを1回読んだ結果。各行はセル文字列のタプル
+    summary_rows: ヘッダー行を除いた先頭 window 行（①用）
+    condition_rows: tbody の先頭 window 行（②用）
+    """
+    __slots__ = ("summary_rows", "condition_rows")
+
+    def __init__(self, summary_rows, condition_rows):
+        self.summary_rows = summary_rows
+        self.condition_rows = condition_rows
+
+
+RACE_DATE_RE = re.compile(r"\d{4}/\d{2}/\d{2}$")
+
+
+def extract_past_rows(table, window: int = PAST_RUNS_WINDOW, since: str = None):
+    """
+    since（YYYY/MM/DD）を渡すと、その日付以前の行に来た時点で読むのをやめる
+    """
     if table is None:
-        return []
+        return PastRuns([], [])
 
-    rows = table.find_all("tr")
-    if not rows or len(rows) <= 1:
-        return []
+    summary_trs = table.find_all("tr")[1:1 + window]
 
-    rows = rows[1:]  # ヘッダー除外
-    past_runs = []
+    # tbody の tr のみ（これが最重要）
+    tbody = table.find("tbody")
+    condition_trs = tbody.find_all("tr")[:window] if tbody is not None else []
 
-    for row in rows[:5]:
-        cols = row.find_all("td")
+    return read_past_rows(
+        summary_trs,
+        condition_trs,
+        lambda tr: tuple(td.get_text(strip=True) for td in tr.find_all("td")),
+        since,
+    )
 
-        # ★ cols が空ならスキップ（これが最重要）
-        if not cols:
-            continue
 
-        def safe(idx):
-            return cols[idx].get_text(strip=True) if idx < len(cols) else ""
-
-        past_runs.append({
-            "date": safe(0),
-            "race": safe(1),
-            "class": safe(2),
-            "distance": safe(3),
-            "condition": safe(4),
-            "finish": safe(5),
-            "time": safe(7),
-            "agari": safe(10),
-            "passing": safe(11),
-            "jockey": safe(12),
-            "weight": safe(13),
-            "body_weight": safe(14),
-        })
+def lxml_extract_past_rows(table, window: int = PAST_RUNS_WINDOW, since: str = None):
+    # extract_past_rows の lxml 版（同じ行・同じセル文字列になる）
+    summary_trs = XP_ROWS(table)[1:1 + window]
+    tbody = XP_TBODY(table)
+    condition_trs = XP_ROWS(tbody[0])[:window] if tbody else []
+
+    return read_past_rows(
+        summary_trs,
+        condition_trs,
+        lambda tr: tuple(lxml_text_strip(td) for td in XP_CELLS(tr)),
+        since,
+    )
+
+
+def read_past_rows(summary_trs, condition_trs, read_cells, since=None):
+    # 両方に出てくる行は同じタプルを使う
+    cells_by_row = {}
+
+    def read(tr):
+        cells = cells_by_row.get(id(tr))
+        if cells is None:
+            cells = read_cells(tr)
+            cells_by_row[id(tr)] = cells
+        return cells
+
+    def read_rows(trs):
+        rows = []
+        for tr in trs:
+            cells = read(tr)
+            if since and cells and RACE_DATE_RE.match(cells[0]) and cells[0] <= since:
+                break
+            rows.append(cells)
+        return rows
+
+    return PastRuns(read_rows(summary_trs), read_rows(condition_trs))
+
 
-    return past_runs
+def rows_to_dicts(rows, columns):
+    # ★ セルが無い行はスキップ、足りない列は空文字
+    return [
+        {key: (cells[idx] if idx < len(cells) else "") for key, idx in columns}
+        for cells in rows
+        if cells
+    ]
+
+
+def past_runs_for_summary(past: PastRuns):
+    return rows_to_dicts(past.summary_rows, SUMMARY_COLUMNS)
+
+
+def past_runs_for_condition(past: PastRuns):
+    return rows_to_dicts(past.condition_rows, CONDITION_COLUMNS)
+
+
+def parse_past_5runs(table):
+    return past_runs_for_summary(extract_past_rows(table))
+
+
+def parse_past_5runs_for_condition(table):
+    return past_runs_for_condition(extract_past_rows(table))
 
 # =========================================================
-# ② 調子スコア計算用（特徴量抽出のための数値データ）
+# 馬ごとの過去走ストア（SQLite）：前回以降に出走し得るときだけ取り直す
 # =========================================================
-def parse_past_5runs_for_condition(table):
-    if table is None:
-        return []
+HORSE_HISTORY_ENABLED = os.environ.get("HORSE_HISTORY_ENABLED", "1") == "1"
+HORSE_HISTORY_PATH = os.environ.get("HORSE_HISTORY_PATH", "/tmp/keiba_horse_history.sqlite3")
+# 前走からこの日数以内は次走があり得ないとみなす
+HORSE_HISTORY_MIN_INTERVAL_DAYS = int(os.environ.get("HORSE_HISTORY_MIN_INTERVAL_DAYS", "7"))
+# 直近に確認済みなら取り直さない（秒）
+HORSE_HISTORY_RECHECK_SECONDS = int(os.environ.get("HORSE_HISTORY_RECHECK_SECONDS", str(6 * 3600)))
+
+JST = timezone(timedelta(hours=9))
+
+
+class HorseHistory:
+    __slots__ = ("past_runs", "features", "last_race_date", "checked_at")
+
+    def __init__(self, past_runs, features, last_race_date, checked_at):
+        self.past_runs = past_runs
+        self.features = features
+        self.last_race_date = last_race_date
+        self.checked_at = checked_at
+
+
+class HorseHistoryStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS horse_history ("
+                "horse_id TEXT PRIMARY KEY, summary_rows TEXT NOT NULL, condition_rows TEXT NOT NULL, "
+                "features TEXT, last_race_date TEXT, checked_at REAL NOT NULL)"
+            )
+            self.conn.commit()
+
+    def get(self, horse_id: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT summary_rows, condition_rows, features, last_race_date, checked_at "
+                "FROM horse_history WHERE horse_id = ?",
+                (horse_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        past_runs = PastRuns(
+            [tuple(r) for r in json.loads(row[0])],
+            [tuple(r) for r in json.loads(row[1])],
+        )
+        features = json.loads(row[2]) if row[2] else None
+        return HorseHistory(past_runs, features, row[3], row[4])
+
+    def put(self, horse_id: str, history: HorseHistory):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO horse_history "
+                "(horse_id, summary_rows, condition_rows, features, last_race_date, checked_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    horse_id,
+                    json.dumps(history.past_runs.summary_rows, ensure_ascii=False),
+                    json.dumps(history.past_runs.condition_rows, ensure_ascii=False),
+                    json.dumps(history.features, ensure_ascii=False) if history.features else None,
+                    history.last_race_date,
+                    history.checked_at,
+                ),
+            )
+            self.conn.commit()
+
+
+horse_history_store = None
+if HORSE_HISTORY_ENABLED and not IS_PARSE_WORKER:
+    try:
+        horse_history_store = HorseHistoryStore(HORSE_HISTORY_PATH)
+    except Exception as e:
+        logging.warning(f"過去走ストア初期化エラー: {e}")
 
-    # tbody の tr のみ取得（これが最重要）
-    tbody = table.find("tbody")
-    if tbody is None:
-        return []
 
-    data_rows = tbody.find_all("tr")
-    if not data_rows:
-        return []
+def latest_race_date(past_runs: PastRuns):
+    dates = [
+        cells[0]
+        for cells in past_runs.summary_rows + past_runs.condition_rows
+        if cells and RACE_DATE_RE.match(cells[0])
+    ]
+    return max(dates) if dates else None
 
-    past_runs = []
 
-    # 最大5走まで
-    for row in data_rows[:5]:
-        cols = row.find_all("td")
-        if not cols:
-            continue
+def history_needs_refresh(history: HorseHistory, now: float):
+    if now - history.checked_at < HORSE_HISTORY_RECHECK_SECONDS:
+        return False
 
-        def safe(idx):
-            try:
-                if idx >= len(cols):
-                    return ""
-                text = cols[idx].get_text(strip=True)
-                return text if text else ""
-            except:
-                return ""
-
-        past_runs.append({
-            "date": safe(0),
-            "race_name": safe(4),
-            "class": safe(2),
-            "rank": safe(11),
-            "time": safe(18),
-            "margin": safe(19),
-            "pop": safe(10),
-            "agari": safe(22),
-            "passing": safe(21),
-            "jockey": safe(12),
-            "weight": safe(13),
-            "distance": safe(14),
-            "baba": safe(16),
-        })
+    if history.last_race_date:
+        last = datetime.strptime(history.last_race_date, "%Y/%m/%d").date()
+        today = datetime.fromtimestamp(now, JST).date()
+        if (today - last).days < HORSE_HISTORY_MIN_INTERVAL_DAYS:
+            return False
+
+    return True
+
+
+def merge_past_runs(new: PastRuns, old: PastRuns, window: int = PAST_RUNS_WINDOW):
+    # 新しい行を前に足して window 件に切る
+    return PastRuns(
+        (new.summary_rows + old.summary_rows)[:window],
+        (new.condition_rows + old.condition_rows)[:window],
+    )
+
+
+def condition_features(past_runs: PastRuns):
+    rows = past_runs_for_condition(past_runs)
+    if not rows:
+        return None, None
+    return extract_features_ajax(rows)
+
+
+def load_horse_history(horse_id: str, tags=None):
+    """
+    過去走と特徴量を (HorseHistory, err) で返す。過去走テーブルが無ければ (None, None)
+    ストアにあり、前回以降に出走し得ない馬はネットワークも解析もしない
+    同じ馬を同時に処理している場合はその結果を共有する
+    """
+    return horse_history_flight.do(horse_id, refresh_horse_history, horse_id, tags or {})
+
+
+def parse_past_runs_page(body: bytes, since=None):
+    """
+    過去走ページ → PastRuns（since より後の行だけ）。テーブルが無ければ None
+    木は最初の table を閉じたところまでしか作らず、行を取り出したら捨てる
+    """
+    html_text = body.decode("euc-jp", errors="replace")
+
+    if PAST_RUNS_PARSER == "lxml":
+        try:
+            # 空や JSON が返ってきた場合の防御
+            if html_text.lstrip()[:1] in ("", "{"):
+                return None
+            table = lxml_stream_find_table(html_text, [XP_FIRST_TABLE])
+            return None if table is None else lxml_extract_past_rows(table, since=since)
+        except Exception as e:
+            logging.warning(f"lxml 過去走解析エラー（BeautifulSoup で再解析）: {e}")
+
+    past_table = extract_past_table_from_ajax(html_text)
+    if past_table is None:
+        return None
+    try:
+        return extract_past_rows(past_table, since=since)
+    finally:
+        dispose_soup(past_table)
+
+
+def refresh_horse_history(horse_id: str, tags: dict):
+    now = time.time()
+    stored = horse_history_store.get(horse_id) if horse_history_store else None
+
+    if stored is not None and not history_needs_refresh(stored, now):
+        metrics.incr("horse_history.hits")
+        return stored, None
+    metrics.incr("horse_history.refresh" if stored is not None else "horse_history.misses")
+
+    with span("past_fetch", **tags):
+        past_page, err = fetch_past_runs_page(horse_id)
+    if err:
+        if stored is not None:
+            # 取り直せなくても前回の内容で続ける
+            logging.warning(f"{horse_id}: {err}（保存済みの過去走を使用）")
+            return stored, None
+        return None, err
+
+    since = stored.last_race_date if stored is not None else None
+    with span("past_parse", **tags):
+        fresh = parse_memo.get_or_parse("past_runs", past_page, parse_past_runs_page, since)
+    if fresh is None:
+        return stored, None
+
+    if stored is not None and not fresh.summary_rows and not fresh.condition_rows:
+        # 新しい行なし：確認時刻だけ更新
+        history = HorseHistory(stored.past_runs, stored.features, stored.last_race_date, now)
+    else:
+        past_runs = merge_past_runs(fresh, stored.past_runs) if stored is not None else fresh
+        with span("features", **tags):
+            features, err = condition_features(past_runs)
+        if err:
+            return None, err
+        history = HorseHistory(past_runs, features, latest_race_date(past_runs), now)
+
+    if horse_history_store is not None:
+        try:
+            horse_history_store.put(horse_id, history)
+        except Exception as e:
+            logging.warning(f"過去走ストア書き込みエラー: {e}")
+
+    return history, None
 
-    return past_runs
 
 # 特徴量抽出
 def extract_features_ajax(past_runs):
@@ -579,12 +2398,102 @@ def calc_condition_score_ajax(f):
     return max(0, min(100, round(score, 2)))
 
 
-def fetch_pedigree_text(horse_id: str):
+# =========================================================
+# 血統（血統表から父・母・母父…だけを取り出す）
+# =========================================================
+# LLM に渡す世代数（1=父母, 2=祖父母まで, 3=曾祖父母まで …）
+PEDIGREE_GENERATIONS = int(os.environ.get("PEDIGREE_GENERATIONS", "3"))
+
+pedigree_token_stats = {"horses": 0, "page_tokens": 0, "compact_tokens": 0}
+_pedigree_token_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text: str):
+    # 目安：ASCII は4文字で1トークン、日本語は1文字1トークン程度
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+def parse_pedigree_table(table, generations: int):
+    """
+    blood_table を {"父": ..., "母": ..., "母父": ...} の形にする
+    セルは「父 → 父父 → … → 母」の先行順に並んでおり、rowspan から世代が分かる
+    """
+    rows = table.find_all("tr")
+    if not rows:
+        return {}
+
+    total_gens = len(rows[0].find_all("td"))
+    pedigree = {}
+    path = []
+
+    for td in table.find_all("td"):
+        try:
+            rowspan = int(td.get("rowspan", 1))
+        except ValueError:
+            rowspan = 1
+        gen = total_gens - (rowspan.bit_length() - 1)
+        if gen < 1:
+            continue
+
+        # 同じ世代をすでに通っていれば母側、そうでなければ父側
+        if len(path) >= gen:
+            path = path[:gen - 1] + ["母"]
+        else:
+            path = path + ["父"]
+
+        if gen > generations:
+            continue
+
+        a = td.find("a")
+        name = a.get_text(strip=True) if a else td.get_text(" ", strip=True)
+        pedigree["".join(path)] = name
+
+    return pedigree
+
+
+def fetch_pedigree(horse_id: str, generations: int = PEDIGREE_GENERATIONS):
+    # 同じ馬の血統を同時に取りに来た場合は1回の取得・解析を共有する
+    return pedigree_flight.do((horse_id, generations), parse_pedigree_page, horse_id, generations)
+
+
+def parse_pedigree_html(html: bytes, generations: int):
+    """
+    血統ページ → (pedigree, ページ全文のトークン数)。血統表が無ければ (None, 0)
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+    try:
+        table = soup.find("table", class_="blood_table")
+        if table is None:
+            return None, 0
+        return parse_pedigree_table(table, generations), estimate_tokens(soup.get_text(" ", strip=True))
+    finally:
+        soup.decompose()
+
+
+def parse_pedigree_page(horse_id: str, generations: int):
     try:
         url = f"https://db.netkeiba.com/horse/ped/{horse_id}/"
-        html = requests.get(url, timeout=10).content
-        soup = BeautifulSoup(html, "lxml")
-        return soup.get_text(" ", strip=True), None
+        html = fetch_page(url, "pedigree")
+        pedigree, page_tokens = parse_memo.get_or_parse("pedigree", html, parse_pedigree_html, generations)
+        if pedigree is None:
+            logging.warning(f"血統表が見つかりません: {horse_id}")
+            return {}, None
+
+        # ページ全文を渡していた場合と比べて何トークン減ったか
+        compact_tokens = estimate_tokens(json.dumps(pedigree, ensure_ascii=False))
+        with _pedigree_token_stats_lock:
+            pedigree_token_stats["horses"] += 1
+            pedigree_token_stats["page_tokens"] += page_tokens
+            pedigree_token_stats["compact_tokens"] += compact_tokens
+        logging.info(
+            f"pedigree {horse_id}: {page_tokens} -> {compact_tokens} tokens "
+            f"(saved {page_tokens - compact_tokens})"
+        )
+
+        return pedigree, None
     except Exception as e:
         return None, f"血統取得エラー: {e}"
 
@@ -602,13 +2511,458 @@ def extract_json(text):
         return None
 
 
-def generate_summary(client, context_json):
+# =========================================================
+# AI要約キャッシュ（プロンプト + モデル設定のハッシュをキーにする）
+# =========================================================
+# memory / sqlite / none
+SUMMARY_CACHE_BACKEND = os.environ.get("SUMMARY_CACHE_BACKEND", "memory")
+SUMMARY_CACHE_PATH = os.environ.get("SUMMARY_CACHE_PATH", "/tmp/keiba_summary_cache.sqlite3")
+SUMMARY_CACHE_TTL = int(os.environ.get("SUMMARY_CACHE_TTL", str(7 * 24 * 3600)))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", "2048"))
+# sqlite から期限切れの行を消す間隔（秒）
+SUMMARY_CACHE_PRUNE_INTERVAL = int(os.environ.get("SUMMARY_CACHE_PRUNE_INTERVAL", "3600"))
+
+
+def summary_cache_key(prompt: str):
+    payload = json.dumps(
+        {
+            "model": LLM_MODEL,
+            "temperature": LLM_TEMPERATURE,
+            "api_version": OPENAI_API_VERSION,
+            "prompt": prompt,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    バックエンド共通部分。_load / _store を実装すれば差し替えられる
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self._load(key, time.time() - self.ttl)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: dict):
+        self._store(key, value, time.time())
+
+    def stats(self):
+        with self.lock:
+            return {"backend": type(self).__name__, "hits": self.hits, "misses": self.misses}
+
+    def _load(self, key, min_created_at):
+        return None
+
+    def _store(self, key, value, created_at):
+        pass
+
+
+class MemorySummaryCache(SummaryCache):
+    def __init__(self, ttl: int, max_entries: int):
+        super().__init__(ttl)
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()  # key -> (created_at, value)
+
+    def _load(self, key, min_created_at):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < min_created_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key, value, created_at):
+        with self.lock:
+            self.entries[key] = (created_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SqliteSummaryCache(SummaryCache):
+    def __init__(self, ttl: int, path: str, prune_interval: int = SUMMARY_CACHE_PRUNE_INTERVAL):
+        super().__init__(ttl)
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.prune_interval = prune_interval
+        self.pruned_at = 0.0
+        with self.db_lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS summaries_created_at ON summaries (created_at)")
+            self.conn.commit()
+        self.prune(time.time())
+
+    def prune(self, now):
+        """
+        TTL を過ぎた行を削除する（読み出し時に弾くだけだと /tmp のファイルが増え続ける）
+        """
+        with self.db_lock:
+            deleted = self.conn.execute("DELETE FROM summaries WHERE created_at < ?", (now - self.ttl,)).rowcount
+            self.conn.commit()
+            self.pruned_at = now
+        if deleted:
+            logging.info(f"AI要約キャッシュ(sqlite): 期限切れ {deleted} 件を削除")
+
+    def _load(self, key, min_created_at):
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT value FROM summaries WHERE key = ? AND created_at >= ?",
+                (key, min_created_at),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, key, value, created_at):
+        with self.db_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, value, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), created_at),
+            )
+            self.conn.commit()
+            due = created_at - self.pruned_at >= self.prune_interval
+        if due:
+            self.prune(created_at)
+
+
+def make_summary_cache(backend: str):
+    if backend == "memory":
+        return MemorySummaryCache(SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
+    if backend == "sqlite":
+        try:
+            return SqliteSummaryCache(SUMMARY_CACHE_TTL, SUMMARY_CACHE_PATH)
+        except Exception as e:
+            logging.warning(f"AI要約キャッシュ(sqlite)初期化エラー: {e}")
+            return MemorySummaryCache(SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
+    return SummaryCache(SUMMARY_CACHE_TTL)
+
+
+summary_cache = make_summary_cache("none" if IS_PARSE_WORKER else SUMMARY_CACHE_BACKEND)
+
+
+# =========================================================
+# Azure OpenAI 呼び出しのスケジューラ（RPM/TPM・優先度・429 対応）
+# =========================================================
+LLM_RPM = int(os.environ.get("LLM_RPM", "60"))
+LLM_TPM = int(os.environ.get("LLM_TPM", "60000"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+# TPM の見積もりに足す出力トークン数
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.environ.get("LLM_EXPECTED_COMPLETION_TOKENS", "400"))
+
+# 発走時刻が分からないレースの優先度（小さいほど先）
+LLM_DEFAULT_PRIORITY = float("inf")
+
+# 発走時刻を覚えておくレース数と、発走後に覚えておく時間（秒）
+LLM_POST_TIMES_MAX_ENTRIES = int(os.environ.get("LLM_POST_TIMES_MAX_ENTRIES", "1024"))
+LLM_POST_TIMES_KEEP_AFTER = int(os.environ.get("LLM_POST_TIMES_KEEP_AFTER", str(6 * 3600)))
+
+race_post_times = OrderedDict()  # race_id -> 発走時刻（epoch 秒）
+race_post_times_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class LLMTask:
+    __slots__ = ("key", "fn", "tokens", "priority", "future", "enqueued_at", "not_before", "attempts")
+
+    def __init__(self, key, fn, tokens, priority):
+        self.key = key
+        self.fn = fn
+        self.tokens = tokens
+        self.priority = priority
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.not_before = 0.0
+        self.attempts = 0
+
+
+def retry_after_seconds(e):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_rate_limited(e):
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429
+
+
+def is_transient_llm_error(e):
+    """
+    再試行すれば通りうるエラー（5xx・タイムアウト・接続エラー）
+    """
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status >= 500
+    try:
+        from openai import APIConnectionError  # APITimeoutError もこのサブクラス
+    except Exception:
+        return False
+    return isinstance(e, APIConnectionError)
+
+
+class LLMScheduler:
+    """
+    LLM 呼び出しを優先度付きキューに積み、RPM/TPM の範囲で順に実行する
+    同じ key の呼び出しが実行中なら、その結果を共有する
+    """
+
+    def __init__(self, rpm: int, tpm: int, concurrency: int, max_retries: int):
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.cond = threading.Condition()
+        self.heap = []  # (priority, seq, task) すぐ実行してよいタスク
+        self.delayed = []  # (not_before, seq, task) 再試行の待ち時間中のタスク
+        self.seq = 0
+        self.inflight = {}  # key -> Future
+        self.running = 0
+        self.cooldown_until = 0.0
+        self.workers = []
+        self.waits = deque(maxlen=METRICS_WINDOW)
+        self.counts = {
+            "submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "rate_limited": 0, "retried": 0,
+        }
+
+    def submit(self, key, fn, tokens, priority=LLM_DEFAULT_PRIORITY):
+        with self.cond:
+            self.counts["submitted"] += 1
+            existing = self.inflight.get(key)
+            if existing is not None:
+                self.counts["deduplicated"] += 1
+                return existing
+
+            task = LLMTask(key, fn, tokens, priority)
+            self.inflight[key] = task.future
+            self._push(task)
+
+            if len(self.workers) < self.concurrency:
+                worker = threading.Thread(target=self._worker, name="llm-scheduler", daemon=True)
+                self.workers.append(worker)
+                worker.start()
+        return task.future
+
+    def call(self, key, fn, tokens, priority=LLM_DEFAULT_PRIORITY):
+        return self.submit(key, fn, tokens, priority).result()
+
+    def _push(self, task):
+        self.seq += 1
+        heapq.heappush(self.heap, (task.priority, self.seq, task))
+        self.cond.notify()
+
+    def _push_delayed(self, task, delay):
+        # 待ち時間中のタスクは実行待ちの heap に入れない（先頭に居座って他の呼び出しを止めないように）
+        task.not_before = time.monotonic() + delay
+        self.seq += 1
+        heapq.heappush(self.delayed, (task.not_before, self.seq, task))
+        self.cond.notify()
+
+    def _next_task(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self._push(heapq.heappop(self.delayed)[2])
+                if not self.heap:
+                    self.cond.wait(timeout=min(self.delayed[0][0] - now, 1.0) if self.delayed else None)
+                    continue
+
+                task = self.heap[0][2]
+                wait = max(
+                    self.cooldown_until - now,
+                    self.rpm.wait_time(1, now),
+                    self.tpm.wait_time(task.tokens, now),
+                )
+                if wait <= 0:
+                    heapq.heappop(self.heap)
+                    self.rpm.take(1)
+                    self.tpm.take(task.tokens)
+                    self.running += 1
+                    self.waits.append(now - task.enqueued_at)
+                    return task
+                if self.delayed:
+                    wait = min(wait, self.delayed[0][0] - now)
+                self.cond.wait(timeout=min(max(wait, 0.0), 1.0))
+
+    def _worker(self):
+        while True:
+            task = self._next_task()
+            task.attempts += 1
+            try:
+                result = task.fn()
+            except Exception as e:
+                rate_limited = is_rate_limited(e)
+                if (rate_limited or is_transient_llm_error(e)) and task.attempts <= self.max_retries:
+                    # Retry-After があれば従い、なければ指数バックオフ
+                    delay = retry_after_seconds(e) or min(30.0, 2 ** task.attempts)
+                    with self.cond:
+                        self.running -= 1
+                        if rate_limited:
+                            # 429 は他の呼び出しも通らないので全体を止める
+                            self.counts["rate_limited"] += 1
+                            self.cooldown_until = max(self.cooldown_until, time.monotonic() + delay)
+                        else:
+                            self.counts["retried"] += 1
+                        self._push_delayed(task, delay)
+                    continue
+                self._finish(task, error=e)
+                continue
+
+            # 実際の使用トークンが分かれば見積もりとの差を反映
+            usage = getattr(getattr(result, "usage", None), "total_tokens", None)
+            if isinstance(usage, int):
+                with self.cond:
+                    self.tpm.tokens -= usage - task.tokens
+            self._finish(task, result=result)
+
+    def _finish(self, task, result=None, error=None):
+        with self.cond:
+            self.running -= 1
+            self.inflight.pop(task.key, None)
+            self.counts["failed" if error is not None else "completed"] += 1
+            self.cond.notify()
+        if error is not None:
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+
+    def stats(self):
+        with self.cond:
+            waits = sorted(self.waits)
+            return {
+                **self.counts,
+                "queue_depth": len(self.heap) + len(self.delayed),
+                "running": self.running,
+                "inflight_keys": len(self.inflight),
+                "cooldown_remaining_s": round(max(0.0, self.cooldown_until - time.monotonic()), 2),
+                "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                "wait_max_ms": round(waits[-1] * 1000, 1) if waits else None,
+            }
+
+
+llm_scheduler = LLMScheduler(LLM_RPM, LLM_TPM, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES)
+
+
+def extract_race_date(html_bytes: bytes):
+    """
+    出馬表ページの開催日（リンクの kaisai_date=YYYYMMDD か「YYYY年M月D日」）。分からなければ None
+    """
+    m = re.search(rb"kaisai_date=(\d{4})(\d{2})(\d{2})", html_bytes)
+    if m is None:
+        for encoding in ("euc-jp", "utf-8"):
+            pattern = r"(\d{4})年(\d{1,2})月(\d{1,2})日".encode(encoding)
+            m = re.search(pattern, html_bytes)
+            if m:
+                break
+    if m is None:
+        return None
+    try:
+        return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=JST).date()
+    except ValueError:
+        return None
+
+
+def extract_post_time(html_bytes: bytes):
+    """
+    出馬表ページの「15:40発走」と開催日から発走時刻を epoch 秒で返す
+    開催日が書かれていなければ今日（JST）の発走とみなす
+    """
+    for encoding in ("euc-jp", "utf-8"):
+        marker = re.escape("発走".encode(encoding))
+        m = re.search(rb"(\d{1,2}):(\d{2})\s*" + marker, html_bytes)
+        if m:
+            day = extract_race_date(html_bytes) or datetime.now(JST).date()
+            post = datetime(day.year, day.month, day.day, int(m.group(1)), int(m.group(2)), tzinfo=JST)
+            return post.timestamp()
+    return None
+
+
+def set_race_post_time(race_id, post_time):
+    with race_post_times_lock:
+        race_post_times[race_id] = post_time
+        race_post_times.move_to_end(race_id)
+        # 発走から時間が経ったレースと、古いものから上限を超えた分を捨てる
+        expired_before = time.time() - LLM_POST_TIMES_KEEP_AFTER
+        for key in [k for k, t in race_post_times.items() if t < expired_before]:
+            del race_post_times[key]
+        while len(race_post_times) > max(1, LLM_POST_TIMES_MAX_ENTRIES):
+            race_post_times.popitem(last=False)
+
+
+def race_priority(race_id):
+    # 発走が近い（早い）レースほど先に処理する
+    with race_post_times_lock:
+        return race_post_times.get(race_id, LLM_DEFAULT_PRIORITY)
+
+
+def chat_completion(client, prompt: str, key: str, race_id=None):
     """
-    client: AzureOpenAI クライアント
-    context_json: JSON文字列（horse, past_runs, features, pedigree を含む）
+    スケジューラ経由で chat.completions.create を呼ぶ（例外はそのまま投げる）
     """
+    return llm_scheduler.call(
+        key,
+        lambda: client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=LLM_TEMPERATURE,
+        ),
+        estimate_tokens(prompt) + LLM_EXPECTED_COMPLETION_TOKENS,
+        race_priority(race_id),
+    )
+
 
-    prompt = f"""
+def build_summary_prompt(context_json):
+    return f"""
 あなたは競馬の分析アナリストです。
 
 以下の馬の「調子スコア」がどの特徴量に基づいて高い/低いのか、
@@ -626,12 +2980,24 @@ def generate_summary(client, context_json):
 }}
 """
 
+
+def generate_summary(client, context_json, race_id=None):
+    """
+    client: AzureOpenAI クライアント
+    context_json: JSON文字列（horse, past_runs, features, pedigree を含む）
+    race_id: 発走時刻による優先度づけに使う
+    """
+
+    prompt = build_summary_prompt(context_json)
+
+    # ★ 同じプロンプト・同じモデル設定なら前回の要約を再利用
+    cache_key = summary_cache_key(prompt)
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        return cached, None
+
     try:
-        response = client.chat.completions.create(
-            model="keiba-gpt4omini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-        )
+        response = chat_completion(client, prompt, cache_key, race_id)
 
         # ★ content が None のケースがある
         content = getattr(response.choices[0].message, "content", None)
@@ -645,6 +3011,8 @@ def generate_summary(client, context_json):
         if summary is None:
             return None, f"LLM JSON抽出エラー: {content}"
 
+        summary_cache.set(cache_key, summary)
+
         # ★ 必ず (summary, None) のタプルで返す
         return summary, None
 
@@ -653,10 +3021,141 @@ def generate_summary(client, context_json):
         return None, f"LLM要約エラー: {e}"
 
 
-def render_card(h, score, summary, past_runs):
+# =========================================================
+# AI要約のまとめ実行（複数頭を1リクエストに詰める）
+# =========================================================
+# 1リクエストに詰めるコンテキストの推定トークン上限（0 ならまとめない）
+LLM_BATCH_TOKEN_BUDGET = int(os.environ.get("LLM_BATCH_TOKEN_BUDGET", "8000"))
+# 1リクエストあたりの最大頭数（出力が長くなりすぎないように）
+LLM_BATCH_MAX_HORSES = int(os.environ.get("LLM_BATCH_MAX_HORSES", "6"))
+# まとめたリクエストを同時にいくつ投げるか
+LLM_BATCH_CONCURRENCY = int(os.environ.get("LLM_BATCH_CONCURRENCY", "3"))
+
+SUMMARY_KEYS = ("strong", "weak", "reason", "suitability")
+
+
+def build_batch_prompt(items):
+    horses = "\n".join(
+        f'{{"horse_id": "{horse_id}", "data": {context}}}' for horse_id, context in items
+    )
+    return f"""
+あなたは競馬の分析アナリストです。
+
+以下の各馬について「調子スコア」がどの特徴量に基づいて高い/低いのか、
+その根拠を数値ベースで説明してください。
+
+【入力データ（1行に1頭、JSON）】
+{horses}
+
+【出力フォーマット（必ず JSON。キーは入力の horse_id、全頭分）】
+{{
+  "<horse_id>": {{
+    "strong": "強みを具体的に。どの数値が良いのか？",
+    "weak": "弱みを具体的に。どの数値が悪いのか？",
+    "reason": "調子スコアの根拠を数値ベースで説明（例：平均着差、アガリ、ペース安定性など）",
+    "suitability": "適性を説明"
+  }}
+}}
+"""
+
+
+def pack_batches(items, token_budget, max_horses):
+    batches = []
+    current = []
+    current_tokens = 0
+    for horse_id, context in items:
+        tokens = estimate_tokens(context)
+        if current and (current_tokens + tokens > token_budget or len(current) >= max_horses):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((horse_id, context))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def summarize_batch(client, batch, race_id=None):
+    """
+    batch: [(horse_id, context_json)]。戻り値 {horse_id: summary}（取れなかった馬は含まない）
+    """
+    prompt = build_batch_prompt(batch)
+    try:
+        response = chat_completion(client, prompt, summary_cache_key(prompt), race_id)
+        content = getattr(response.choices[0].message, "content", None)
+    except Exception as e:
+        logging.warning(f"LLM まとめ要約エラー: {e}")
+        return {}
+
+    parsed = extract_json(content or "")
+    if not isinstance(parsed, dict):
+        logging.warning("LLM まとめ要約の JSON を解析できませんでした")
+        return {}
+
+    results = {}
+    for horse_id, _ in batch:
+        summary = parsed.get(horse_id)
+        if isinstance(summary, dict) and all(k in summary for k in SUMMARY_KEYS):
+            results[horse_id] = summary
+    return results
+
+
+def generate_summaries(client, items, race_id=None):
+    """
+    items: [(horse_id, context_json)] → {horse_id: (summary, err)}
+    キャッシュにない馬をまとめて要約し、取れなかった馬だけ1頭ずつ呼び直す
+    """
+    results = {}
+    pending = []
+    keys = {}
+    for horse_id, context in items:
+        key = summary_cache_key(build_summary_prompt(context))
+        keys[horse_id] = key
+        cached = summary_cache.get(key)
+        if cached is not None:
+            results[horse_id] = (cached, None)
+        else:
+            pending.append((horse_id, context))
+
+    if not pending:
+        return results
+
+    contexts = dict(pending)
+    fallback = list(pending)
+
+    if LLM_BATCH_TOKEN_BUDGET > 0 and len(pending) > 1:
+        batches = pack_batches(pending, LLM_BATCH_TOKEN_BUDGET, max(1, LLM_BATCH_MAX_HORSES))
+        with ThreadPoolExecutor(max_workers=max(1, min(LLM_BATCH_CONCURRENCY, len(batches)))) as executor:
+            batch_results = list(executor.map(lambda b: summarize_batch(client, b, race_id), batches))
+        metrics.incr("llm.batch_calls", len(batches))
+
+        for found in batch_results:
+            for horse_id, summary in found.items():
+                summary_cache.set(keys[horse_id], summary)
+                results[horse_id] = (summary, None)
+        fallback = [(horse_id, contexts[horse_id]) for horse_id, _ in pending if horse_id not in results]
+        if fallback:
+            metrics.incr("llm.batch_fallbacks", len(fallback))
+
+    # まとめて取れなかった馬は従来どおり1頭ずつ
+    if fallback:
+        with ThreadPoolExecutor(max_workers=max(1, min(LLM_BATCH_CONCURRENCY, len(fallback)))) as executor:
+            singles = list(executor.map(lambda item: generate_summary(client, item[1], race_id), fallback))
+        for (horse_id, _), res in zip(fallback, singles):
+            results[horse_id] = res
+
+    return results
+
+
+def render_card(h, score, summary, past_runs=None):
+    # エラー文言や簡易要約（文字列）は根拠欄に表示する
+    if not isinstance(summary, dict):
+        summary = {"reason": summary}
+
     # 過去走テーブルHTMLを作成
     past_rows = ""
-    for r in past_runs:
+    for r in past_runs or []:
         past_rows += f"""
         <tr>
           <td>{r.get("date","")}</td>
@@ -694,12 +3193,12 @@ def render_card(h, score, summary, past_runs):
   <p><b>弱み:</b> {summary.get("weak", "")}</p>
   <p><b>適性:</b> {summary.get("suitability", "")}</p>
 
-  <h4>過去5走</h4>
+  <h4>過去{PAST_RUNS_WINDOW}走</h4>
   {past_table}
 </div>
 """
 
-def wrap_html(race_id, body):
+def wrap_html_head(race_id):
     return f"""
 <html>
 <head>
@@ -708,11 +3207,180 @@ def wrap_html(race_id, body):
 </head>
 <body>
 <h2>調子分析レポート（race_id: {race_id}）</h2>
-{body}
+"""
+
+
+def wrap_html_tail():
+    return """
 </body>
 </html>
 """
 
+
+def wrap_html(race_id, body):
+    return wrap_html_head(race_id) + body + wrap_html_tail()
+
+def umaban_key(h):
+    try:
+        return int(h.get("umaban", 0))
+    except:
+        return 999
+
+
+class HorsePrep:
+    """
+    AI要約の直前までの結果。card があればその時点で終了（エラー等）
+    """
+    __slots__ = ("h", "score", "past_runs_summary", "context", "card")
+
+    def __init__(self, h, score=0, past_runs_summary=None, context=None, card=None):
+        self.h = h
+        self.score = score
+        self.past_runs_summary = past_runs_summary
+        self.context = context
+        self.card = card
+
+
+def prepare_horse(h, race_id=None):
+    """
+    1頭分の前処理（過去走取得 → 特徴量 → 血統 → LLM 用コンテキスト）
+    """
+    horse_id = h["horse_id"]
+    tags = {"race_id": race_id, "horse_id": horse_id}
+
+    # 過去走（ストアにあればネットワーク・解析なし）
+    history, err = load_horse_history(horse_id, tags)
+    if err:
+        logging.warning(f"{horse_id}: {err}")
+        return HorsePrep(h, card=render_card(h, 0, err))
+    if history is None:
+        return HorsePrep(h, card=render_card(h, 0, "過去走テーブルなし"))
+
+    past_runs = history.past_runs
+    features = history.features
+
+    # ---------------------------------------------------------
+    # ① 調子スコア用（詳細データ）
+    # ---------------------------------------------------------
+    if features is None:
+        simple_summary = f"{h['horse_name']} は過去走データが少ないため、簡易AI要約を生成します。"
+        return HorsePrep(h, card=render_card(h, 0, simple_summary, []))
+
+    score = calc_condition_score_ajax(features)
+
+    # ---------------------------------------------------------
+    # ② AI要約用（軽量データ）
+    # ---------------------------------------------------------
+    past_runs_summary = past_runs_for_summary(past_runs)
+
+    with span("pedigree_fetch", **tags):
+        pedigree, err = fetch_pedigree(horse_id)
+    if err:
+        logging.warning(f"{horse_id}: {err}")
+        return HorsePrep(h, card=render_card(h, score, err))
+
+    # LLM に渡すコンテキスト
+    context = json.dumps(
+        {
+            "horse": h,
+            "past_runs": past_runs_summary,
+            "features": features,
+            "pedigree": pedigree,
+        },
+        ensure_ascii=False,
+    )
+
+    return HorsePrep(h, score, past_runs_summary, context)
+
+
+def finish_horse(prep: HorsePrep, summary, err, race_id=None):
+    h = prep.h
+    if err:
+        logging.warning(f"{h['horse_id']}: {err}")
+        return render_card(h, prep.score, err)
+
+    # ★ LLM が None や空、dict 以外を返した場合の安全対策
+    if not summary or not isinstance(summary, dict):
+        summary = f"{h['horse_name']} のAI要約を生成できませんでした（簡易要約）。"
+
+    with span("render", race_id=race_id, horse_id=h["horse_id"]):
+        return render_card(h, prep.score, summary, prep.past_runs_summary)
+
+
+def process_horse(client, h, race_id=None):
+    """
+    1頭分のパイプライン（過去走取得 → 特徴量 → 血統 → AI要約 → カード描画）
+    """
+    prep = prepare_horse(h, race_id)
+    if prep.card is not None:
+        return prep.card
+
+    with span("llm", race_id=race_id, horse_id=h["horse_id"]):
+        summary, err = generate_summary(client, prep.context, race_id)
+
+    return finish_horse(prep, summary, err, race_id)
+
+
+def safe_process_horse(client, h, race_id=None):
+    try:
+        return process_horse(client, h, race_id)
+    except Exception as e:
+        logging.exception(f"process_horse エラー: {h.get('horse_id')}")
+        return render_card(h, 0, f"処理エラー: {e}")
+
+
+def process_horses_batched(client, horses, race_id, executor):
+    """
+    前処理は馬ごとに並列、AI要約はレース分をまとめて実行する
+    """
+    def safe_prepare(h):
+        try:
+            return prepare_horse(h, race_id)
+        except Exception as e:
+            logging.exception(f"prepare_horse エラー: {h.get('horse_id')}")
+            return HorsePrep(h, card=render_card(h, 0, f"処理エラー: {e}"))
+
+    preps = list(executor.map(safe_prepare, horses))
+
+    items = [(p.h["horse_id"], p.context) for p in preps if p.card is None]
+    with span("llm", race_id=race_id, horse_id="batch"):
+        summaries = generate_summaries(client, items, race_id)
+
+    blocks = []
+    for p in preps:
+        if p.card is not None:
+            blocks.append(p.card)
+            continue
+        summary, err = summaries.get(p.h["horse_id"], (None, "LLM要約エラー: 結果なし"))
+        blocks.append(finish_horse(p, summary, err, race_id))
+    return blocks
+
+
+def load_race_horses(url):
+    """
+    出馬表を取得して (horses, err) を返す（馬番順）
+    """
+    race_id = extract_race_id(url)
+    return race_horses_flight.do((race_id, url), read_race_horses, url, race_id)
+
+
+def read_race_horses(url, race_id):
+    try:
+        with span("shutuba_fetch", race_id=race_id):
+            html = fetch_page(url, "shutuba")
+        with span("shutuba_parse", race_id=race_id):
+            horses = parse_shutuba_page(html, with_links=True)
+            post_time = extract_post_time(html)
+        if race_id and post_time:
+            set_race_post_time(race_id, post_time)
+        if horses is None:
+            return None, "出馬表テーブルが見つかりませんでした"
+    except Exception as e:
+        return None, f"出馬表取得エラー: {e}"
+
+    return sorted(horses, key=umaban_key), None
+
+
 @app.route(route="process_past")
 def process_past(req: func.HttpRequest) -> func.HttpResponse:
 
@@ -722,115 +3390,473 @@ def process_past(req: func.HttpRequest) -> func.HttpResponse:
 
     race_id = extract_race_id(url)
 
+    if not memory_available():
+        return memory_busy_response()
+
+    # 同じレースのレポートを作成中なら、その完成を待って同じ HTML を返す
+    full_html, err = past_report_flight.do((race_id, url), build_past_report, url, race_id)
+    if err:
+        return func.HttpResponse(err, status_code=500)
+    return func.HttpResponse(full_html, mimetype="text/html")
+
+
+def build_past_report(url, race_id):
+    """
+    process_past のレポート HTML を (html, err) で返す
+    """
     # 出馬表取得
-    try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        html = requests.get(url, headers=headers, timeout=10).content
-        table = extract_shutuba_table_with_links(html)
-        if table is None:
-            return func.HttpResponse("出馬表テーブルが見つかりませんでした", status_code=500)
-        horses = parse_shutuba_table_with_links(table)
-    except Exception as e:
-        return func.HttpResponse(f"出馬表取得エラー: {e}", status_code=500)
+    horses, err = load_race_horses(url)
+    if err:
+        return None, err
 
     # OpenAI クライアント
     client, err = get_openai_client()
     if err:
-        return func.HttpResponse(err, status_code=500)
+        return None, err
 
-    result_html = ""
+    # 各馬を並列処理（map は入力順を保つので馬番順のまま並ぶ）
+    workers = max(1, min(PROCESS_PAST_MAX_WORKERS, len(horses) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if LLM_BATCH_TOKEN_BUDGET > 0:
+            blocks = process_horses_batched(client, horses, race_id, executor)
+        else:
+            blocks = list(executor.map(lambda h: safe_process_horse(client, h, race_id), horses))
 
-    # 各馬処理
-    for h in horses:
-        horse_id = h["horse_id"]
-        print("\n==============================")
-        print("START HORSE:", h["horse_name"])
-        print("==============================")
+    full_html = wrap_html(race_id, "".join(blocks))
+    logging.info(f"process_past {race_id}: {len(horses)} horses, {len(full_html)} chars")
+    return full_html, None
 
-        # Ajax 過去走取得
-        past_html, err = fetch_past_runs_html(horse_id)
-        print("DEBUG past_html ERR:", err)
-        if err:
-            html_block = render_card(h, 0, err)
-            print("DEBUG render_card (err):", html_block)
-            result_html += html_block
-            continue
+# =========================================================
+# process_past_submit / process_past_status（非同期ジョブ）
+# =========================================================
+# 全ジョブで共有する馬ごとの処理スレッド数
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "8"))
+# 完了したジョブを保持する時間（秒）。同じレースの再投入はこの間は結果を返す
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "1800"))
+# 設定すると完了結果をファイルにも保存し、別インスタンスからも参照できる
+JOB_DIR = os.environ.get("JOB_DIR")
+
+_job_coordinator = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job-coord")
+_job_horse_pool = ThreadPoolExecutor(max_workers=max(1, JOB_MAX_WORKERS), thread_name_prefix="job-horse")
+
+jobs = {}  # job_id -> PastReportJob
+jobs_by_race = {}  # race_id -> job_id
+_jobs_lock = threading.Lock()
+
+
+class PastReportJob:
+    def __init__(self, url: str, race_id: str):
+        self.job_id = uuid.uuid4().hex
+        self.url = url
+        self.race_id = race_id
+        self.status = "queued"  # queued / running / done / error
+        self.total = 0
+        self.done = 0
+        self.blocks = []
+        self.html = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def active(self, now: float):
+        if self.status in ("queued", "running"):
+            return True
+        return self.status == "done" and now - self.finished_at < JOB_TTL_SECONDS
+
+    def to_dict(self, include_html=False):
+        with self.lock:
+            d = {
+                "job_id": self.job_id,
+                "race_id": self.race_id,
+                "status": self.status,
+                "total": self.total,
+                "done": self.done,
+                "progress": round(self.done / self.total, 3) if self.total else 0.0,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+            if self.error:
+                d["error"] = self.error
+            if include_html and self.html is not None:
+                d["html"] = self.html
+        return d
+
+
+def save_job_result(job: PastReportJob):
+    if not JOB_DIR:
+        return
+    try:
+        os.makedirs(JOB_DIR, exist_ok=True)
+        path = os.path.join(JOB_DIR, f"{job.job_id}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(include_html=True), f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.warning(f"ジョブ結果の保存エラー: {e}")
 
-        past_table = extract_past_table_from_ajax(past_html)
-        print("DEBUG past_table:", past_table)
-        if past_table is None:
-            html_block = render_card(h, 0, "過去走テーブルなし")
-            print("DEBUG render_card (no table):", html_block)
-            result_html += html_block
-            continue
 
-        # ---------------------------------------------------------
-        # ① 調子スコア用（詳細データ）
-        # ---------------------------------------------------------
-        past_runs_condition = parse_past_5runs_for_condition(past_table)
-        print("DEBUG past_runs_condition:", past_runs_condition)
-
-        if not past_runs_condition:
-            simple_summary = f"{h['horse_name']} は過去走データが少ないため、簡易AI要約を生成します。"
-            html_block = render_card(h, 0, simple_summary, [])
-            print("DEBUG simple_summary HTML:", html_block)
-            result_html += html_block
-            continue
+def load_job_result(job_id: str):
+    if not JOB_DIR or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    try:
+        with open(os.path.join(JOB_DIR, f"{job_id}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        features, err = extract_features_ajax(past_runs_condition)
-        print("DEBUG features:", features, "ERR:", err)
-        if err:
-            html_block = render_card(h, 0, err)
-            print("DEBUG render_card (feature err):", html_block)
-            result_html += html_block
-            continue
 
-        score = calc_condition_score_ajax(features)
-        print("DEBUG score:", score)
+def finish_job(job: PastReportJob, error: str = None):
+    with job.lock:
+        if error:
+            job.status = "error"
+            job.error = error
+        else:
+            job.html = wrap_html(job.race_id, "".join(job.blocks))
+            job.blocks = []
+            job.status = "done"
+        job.finished_at = time.time()
+    logging.info(f"job {job.job_id} ({job.race_id}) {job.status}")
+    save_job_result(job)
 
-        # ---------------------------------------------------------
-        # ② AI要約用（軽量データ）
-        # ---------------------------------------------------------
-        past_runs_summary = parse_past_5runs(past_table) or []
-        print("DEBUG past_runs_summary:", past_runs_summary)
 
-        pedigree, err = fetch_pedigree_text(horse_id)
-        print("DEBUG pedigree:", pedigree, "ERR:", err)
-        if err:
-            html_block = render_card(h, score, err)
-            print("DEBUG render_card (pedigree err):", html_block)
-            result_html += html_block
-            continue
+def start_job(job: PastReportJob):
+    # 出馬表を読んでから、馬ごとの処理を共有プールへ投げる（完了待ちはしない）
+    with job.lock:
+        job.status = "running"
 
-        # LLM に渡すコンテキスト
-        context = json.dumps(
-            {
-                "horse": h,
-                "past_runs": past_runs_summary,
-                "features": features,
-                "pedigree": pedigree,
-            },
-            ensure_ascii=False,
+    horses, err = load_race_horses(job.url)
+    if err:
+        return finish_job(job, err)
+
+    client, err = get_openai_client()
+    if err:
+        return finish_job(job, err)
+
+    with job.lock:
+        job.total = len(horses)
+        job.blocks = [""] * len(horses)
+    if not horses:
+        return finish_job(job)
+
+    def on_done(index, future):
+        with job.lock:
+            job.blocks[index] = future.result()
+            job.done += 1
+            finished = job.done == job.total
+        if finished:
+            finish_job(job)
+
+    for i, h in enumerate(horses):
+        future = _job_horse_pool.submit(safe_process_horse, client, h, job.race_id)
+        future.add_done_callback(lambda f, i=i: on_done(i, f))
+
+
+def submit_past_report(url: str, race_id: str):
+    """
+    同じ race_id のジョブが実行中（または完了して間もない）ならそれを返す
+    """
+    now = time.time()
+    with _jobs_lock:
+        # 期限切れのジョブを掃除
+        for job_id, job in list(jobs.items()):
+            if not job.active(now):
+                del jobs[job_id]
+                if jobs_by_race.get(job.race_id) == job_id:
+                    del jobs_by_race[job.race_id]
+
+        existing = jobs.get(jobs_by_race.get(race_id))
+        if existing is not None and existing.active(now):
+            return existing, True
+
+        job = PastReportJob(url, race_id)
+        jobs[job.job_id] = job
+        jobs_by_race[race_id] = job.job_id
+
+    _job_coordinator.submit(start_job, job)
+    return job, False
+
+
+@app.route(route="process_past_submit", methods=[func.HttpMethod.GET, func.HttpMethod.POST])
+def process_past_submit(req: func.HttpRequest) -> func.HttpResponse:
+
+    url = req.params.get("url")
+    if not url:
+        try:
+            url = (req.get_json() or {}).get("url")
+        except ValueError:
+            url = None
+    if not url:
+        return func.HttpResponse(
+            json.dumps({"error": "url パラメータが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    race_id = extract_race_id(url)
+    if not race_id:
+        return func.HttpResponse(
+            json.dumps({"error": "race_id を URL から抽出できません"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    if not memory_available():
+        return func.HttpResponse(
+            json.dumps({"error": MEMORY_BUSY_MESSAGE}, ensure_ascii=False),
+            status_code=503,
+            headers={"Retry-After": str(MEMORY_RETRY_AFTER)},
+            mimetype="application/json"
+        )
+
+    job, reused = submit_past_report(url, race_id)
+
+    return func.HttpResponse(
+        json.dumps({**job.to_dict(), "reused": reused}, ensure_ascii=False),
+        status_code=202,
+        mimetype="application/json"
+    )
+
+
+@app.route(route="process_past_status", methods=[func.HttpMethod.GET])
+def process_past_status(req: func.HttpRequest) -> func.HttpResponse:
+
+    job_id = req.params.get("job_id")
+    if not job_id:
+        return func.HttpResponse(
+            json.dumps({"error": "job_id パラメータが必要です"}, ensure_ascii=False),
+            status_code=400,
+            mimetype="application/json"
         )
-        print("DEBUG context:", context)
 
-        summary, err = generate_summary(client, context)
-        print("DEBUG summary:", summary, "ERR:", err)
+    with _jobs_lock:
+        job = jobs.get(job_id)
+    data = job.to_dict(include_html=True) if job else load_job_result(job_id)
+    if data is None:
+        return func.HttpResponse(
+            json.dumps({"error": "ジョブが見つかりません"}, ensure_ascii=False),
+            status_code=404,
+            mimetype="application/json"
+        )
+
+    # format=html なら完成したレポートをそのまま返す
+    if req.params.get("format") == "html" and data.get("html") is not None:
+        return func.HttpResponse(data["html"], mimetype="text/html")
+
+    return func.HttpResponse(
+        json.dumps(data, ensure_ascii=False),
+        status_code=200 if data["status"] in ("done", "error") else 202,
+        mimetype="application/json"
+    )
+
+# =========================================================
+# process_past_stream（できた馬からカードを逐次送信）
+# =========================================================
+# 1 にすると process_past_stream を登録する。fastapi / starlette / pydantic の import で
+# コールドスタートが数百 ms 延びるので既定では無効（解析用の子プロセスでは常に無効）。
+# HTTP ストリーミングには azurefunctions-extensions-http-fastapi（requirements.txt）と
+# アプリ設定 PYTHON_ENABLE_INIT_INDEXING=1（Dockerfile で設定済み）も要る。
+# App Service / Functions の設定画面からデプロイする場合はアプリ設定にも追加すること
+STREAM_ENABLED = os.environ.get("STREAM_ENABLED", "0") == "1" and not IS_PARSE_WORKER
+
+StreamRequest = None
+stream_import_error = "STREAM_ENABLED=1 ではありません"
+if STREAM_ENABLED:
+    try:
+        from azurefunctions.extensions.http.fastapi import (
+            Request as StreamRequest,
+            StreamingResponse,
+            PlainTextResponse,
+        )
+        stream_import_error = None
+    except Exception as e:
+        StreamRequest = None
+        stream_import_error = str(e)
+
+# 未完了の馬のプレースホルダーを、完成したカードで置き換える
+STREAM_SWAP_SCRIPT = """
+<script>
+function fillCard(n) {
+  var t = document.getElementById("card-" + n + "-done");
+  var p = document.getElementById("card-" + n);
+  if (t && p) { p.replaceWith(t.content.cloneNode(true)); t.remove(); }
+}
+</script>
+"""
+
+
+def render_placeholder(h):
+    return (
+        f'<div id="card-{h.get("umaban", "")}" style="border:1px dashed #ccc; padding:10px; margin:10px; border-radius:8px; color:#888;">'
+        f'{h["horse_name"]}（馬番 {h.get("umaban", "")}）… 分析中</div>\n'
+    )
+
+
+def render_card_swap(h, block):
+    n = h.get("umaban", "")
+    return f'<template id="card-{n}-done">{block}</template><script>fillCard("{n}")</script>\n'
+
+
+def stream_past_report(race_id, url, client):
+    # 出馬表の取得を待たずにヘッダーを送る
+    yield wrap_html_head(race_id) + STREAM_SWAP_SCRIPT
+
+    horses, err = load_race_horses(url)
+    if err:
+        # ステータスは送信済みなので本文にエラーを出して終える
+        yield f"<p>{err}</p>\n" + wrap_html_tail()
+        return
+
+    yield "".join(render_placeholder(h) for h in horses)
+
+    # 完了した順にカードを送る（表示位置はプレースホルダーで馬番順に固定）
+    workers = max(1, min(PROCESS_PAST_MAX_WORKERS, len(horses) or 1))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(safe_process_horse, client, h, race_id): h for h in horses}
+        for future in as_completed(futures):
+            yield render_card_swap(futures.pop(future), future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    yield wrap_html_tail()
+
+
+if StreamRequest is not None:
+
+    @app.route(route="process_past_stream", methods=[func.HttpMethod.GET])
+    async def process_past_stream(req: StreamRequest):
+
+        url = req.query_params.get("url")
+        if not url:
+            return PlainTextResponse("url パラメータが必要です", status_code=400)
 
-        # ★ LLM が None や空文字、文字列以外を返した場合の安全対策
-        if not summary or not isinstance(summary, str):
-            summary = f"{h['horse_name']} のAI要約を生成できませんでした（簡易要約）。"
+        race_id = extract_race_id(url)
 
+        if not memory_available():
+            return PlainTextResponse(
+                MEMORY_BUSY_MESSAGE,
+                status_code=503,
+                headers={"Retry-After": str(MEMORY_RETRY_AFTER)},
+            )
+
+        client, err = get_openai_client()
         if err:
-            html_block = render_card(h, score, err)
-            print("DEBUG render_card (LLM err):", html_block)
-            result_html += html_block
-            continue
+            return PlainTextResponse(err, status_code=500)
 
-        html_block = render_card(h, score, summary, past_runs_summary)
-        print("DEBUG render_card (LLM OK):", html_block)
-        result_html += html_block
+        return StreamingResponse(
+            stream_past_report(race_id, url, client),
+            media_type="text/html; charset=utf-8",
+        )
+else:
+    logging.info(f"process_past_stream は無効です: {stream_import_error}")
 
-    full_html = wrap_html(race_id, result_html)
-    print("DEBUG FINAL HTML LENGTH:", len(full_html))
-    return func.HttpResponse(full_html, mimetype="text/html")
+# =========================================================
+# metrics 関数（処理時間・キャッシュ・上流エラーの集計）
+# =========================================================
+@app.route(route="metrics", methods=[func.HttpMethod.GET])
+def metrics_route(req: func.HttpRequest) -> func.HttpResponse:
+    snapshot = metrics.snapshot()
+    snapshot["caches"] = {
+        "page": page_cache.stats(),
+        "parse_memo": parse_memo.stats(),
+        "summary": summary_cache.stats(),
+    }
+    snapshot["pedigree_tokens"] = dict(pedigree_token_stats)
+    snapshot["llm_scheduler"] = llm_scheduler.stats()
+    snapshot["single_flight"] = {f.name: f.stats() for f in SINGLE_FLIGHTS}
+    snapshot["memory"] = {
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        "soft_limit_mb": MEMORY_SOFT_LIMIT_MB,
+    }
+    snapshot["trace_enabled"] = TRACE_ENABLED
+
+    return func.HttpResponse(
+        json.dumps(snapshot, ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+# =========================================================
+# warmup 関数（重いモジュール・パーサー・接続を先に用意する）
+# =========================================================
+# 1 にするとワーカー起動時にバックグラウンドでウォームアップする
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "0") == "1"
+# 1 にすると netkeiba に実際に接続し、TLS 済みの接続をプールに残す
+WARMUP_CONNECT = os.environ.get("WARMUP_CONNECT", "0") == "1"
+# Premium / Flex プランのウォームアップトリガーを登録する
+WARMUP_TRIGGER_ENABLED = os.environ.get("WARMUP_TRIGGER_ENABLED", "0") == "1"
+WARMUP_HOSTS = ("race.netkeiba.com", "db.netkeiba.com")
+
+_warmup_result = None
+_warmup_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    最初のリクエストで払うコスト（import・XPath コンパイル・ルール読み込み・
+    セッション作成）を先に済ませる。2回目以降は最初の結果を返すだけ
+    """
+    global _warmup_result
+
+    with _warmup_lock:
+        if _warmup_result is not None:
+            return _warmup_result
+
+        timings = {}
+        errors = {}
+
+        def step(name, fn):
+            start = time.perf_counter()
+            try:
+                fn()
+            except Exception as e:
+                errors[name] = str(e)
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+        def openai_client():
+            _, err = get_openai_client()
+            if err:
+                raise RuntimeError(err)
+
+        step("scoring", lambda: score_horses([{"waku": "1", "umaban": "1", "odds": "1.0"}]))
+        step("shutuba_parser", lambda: parse_shutuba_page(b"<table class='Shutuba_Table'><tr></tr></table>"))
+        step("bs4", lambda: (extract_shutuba_table(b"<table></table>"), extract_past_table_from_ajax("")))
+        step("openai", openai_client)
+        if PARSE_PROCESSES > 0:
+            # 子プロセスの起動と、各子プロセスでの function_app・パーサーの import を先に済ませる
+            step("parse_pool", warm_parse_pool)
+
+        for host in WARMUP_HOSTS:
+            def open_session(host=host):
+                session = get_session(host)
+                if WARMUP_CONNECT:
+                    session.head(f"https://{host}/", timeout=5)
+
+            step(f"session.{host}", open_session)
+
+        _warmup_result = {
+            "total_ms": round(sum(timings.values()), 1),
+            "steps_ms": timings,
+            "errors": errors,
+        }
+        logging.info(f"warmup 完了: {_warmup_result}")
+        return _warmup_result
+
+
+@app.route(route="warmup", methods=[func.HttpMethod.GET])
+def warmup(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps(warm_up(), ensure_ascii=False),
+        mimetype="application/json"
+    )
+
+
+if WARMUP_TRIGGER_ENABLED:
+    @app.warm_up_trigger("warmup_context")
+    def warmup_trigger(warmup_context) -> None:
+        warm_up()
+
+
+if WARMUP_ON_START and not IS_PARSE_WORKER:
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
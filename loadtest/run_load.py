@@ -0,0 +1,277 @@
+"""
+レース当日の同時アクセスを想定した負荷試験（netkeiba / Azure OpenAI はローカルのスタブ）
+
+    python loadtest/run_load.py --rps 5 --duration 60 --races 6
+    python loadtest/run_load.py --mix shutuba=0.6,odds_refresh=0.3,process_past=0.1 --llm-429-rate 0.05
+    python loadtest/run_load.py --base-url http://localhost:7071/api   # func start 中のホストを叩く
+
+既定では function_app をこのプロセスに読み込み、ルート関数を直接呼ぶ。
+--base-url を指定した場合は HTTP で呼ぶので、ホスト側に表示される環境変数を設定しておくこと。
+リクエストは一定間隔で送り（前のリクエストの完了を待たない）、
+レイテンシは送信予定時刻から完了までで測る
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import stub_servers  # noqa: E402
+
+ROUTES = ("shutuba", "process_past", "odds_refresh", "score_and_rank")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ROUTES:
+            raise SystemExit(f"未対応のルート: {name}（{', '.join(ROUTES)}）")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def race_ids(count):
+    # 2026年 東京 4回 8日 の 1R〜12R（12 を超えたら次の開催日）
+    return [f"20260504{8 + i // 12:02d}{i % 12 + 1:02d}" for i in range(count)]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+# =========================================================
+# ルートの呼び出し（同一プロセス / HTTP）
+# =========================================================
+class InProcessTarget:
+    def __init__(self):
+        sys.path.insert(0, ROOT)
+        import azure.functions as func
+        import function_app
+
+        self.func = func
+        self.handlers = {name: getattr(function_app, name)._function.get_user_function() for name in ROUTES}
+        self.handlers["metrics"] = function_app.metrics_route._function.get_user_function()
+
+    def call(self, route, params=None, body=None):
+        req = self.func.HttpRequest(
+            method="POST" if body is not None else "GET",
+            url=f"http://localhost/api/{route}",
+            params=params or {},
+            body=json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b"",
+        )
+        res = self.handlers[route](req)
+        return res.status_code, res.get_body()
+
+    def metrics(self):
+        return json.loads(self.call("metrics")[1])
+
+
+class HttpTarget:
+    def __init__(self, base_url):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=256)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def call(self, route, params=None, body=None):
+        url = f"{self.base_url}/{route}"
+        if body is not None:
+            res = self.session.post(url, params=params, json=body, timeout=300)
+        else:
+            res = self.session.get(url, params=params, timeout=300)
+        return res.status_code, res.content
+
+    def metrics(self):
+        try:
+            status, body = self.call("metrics")
+            return json.loads(body) if status == 200 else {}
+        except Exception:
+            return {}
+
+
+# =========================================================
+# 負荷の生成と集計
+# =========================================================
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # route -> [秒]
+        self.statuses = {}  # route -> {status: 件数}
+        self.last_end = None
+
+    def record(self, route, status, latency, end):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(latency)
+            by_status = self.statuses.setdefault(route, {})
+            by_status[status] = by_status.get(status, 0) + 1
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def summary(self, started):
+        rows = {}
+        all_latencies = []
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            all_latencies.extend(values)
+            rows[route] = self.row(values, self.statuses[route], started)
+        all_latencies.sort()
+        statuses = {}
+        for by_status in self.statuses.values():
+            for status, n in by_status.items():
+                statuses[status] = statuses.get(status, 0) + n
+        rows["total"] = self.row(all_latencies, statuses, started)
+        return rows
+
+    def row(self, values, statuses, started):
+        elapsed = (self.last_end or started) - started
+        ok = sum(n for status, n in statuses.items() if isinstance(status, int) and status < 400)
+        return {
+            "requests": len(values),
+            "ok": ok,
+            "statuses": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+            "throughput_rps": round(len(values) / elapsed, 2) if elapsed > 0 else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+        }
+
+
+def request_for(route, race_id, horses):
+    url = f"https://race.netkeiba.com/race/shutuba_past.html?race_id={race_id}"
+    if route in ("shutuba", "process_past"):
+        return {"url": url}, None
+    if route == "odds_refresh":
+        return {"race_id": race_id}, None
+    return None, {"horses": horses}
+
+
+def run_load(target, args, mix, races):
+    # score_and_rank 用の馬リスト
+    horses = []
+    if "score_and_rank" in mix:
+        status, body = target.call("shutuba", {"url": f"https://race.netkeiba.com/race/shutuba_past.html?race_id={races[0]}"})
+        horses = json.loads(body).get("horses", []) if status == 200 else []
+
+    rng = random.Random(args.seed)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    total = int(args.rps * args.duration)
+    interval = 1.0 / args.rps
+    recorder = Recorder()
+    late = 0
+
+    def one(route, params, body, due):
+        try:
+            status, _ = target.call(route, params, body)
+        except Exception as e:
+            status = type(e).__name__
+        end = time.perf_counter()
+        recorder.record(route, status, end - due, end)
+
+    executor = ThreadPoolExecutor(max_workers=args.max_inflight)
+    started = time.perf_counter()
+    for i in range(total):
+        due = started + i * interval
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        elif wait < -interval:
+            late += 1
+        route = rng.choices(names, weights)[0]
+        race_id = races[min(int(rng.paretovariate(1.2)) - 1, len(races) - 1)] if args.skew else rng.choice(races)
+        params, body = request_for(route, race_id, horses)
+        executor.submit(one, route, params, body, due)
+    executor.shutdown(wait=True)
+
+    return recorder.summary(started), late
+
+
+def main():
+    parser = argparse.ArgumentParser(description="keiba-ai-api load test with stub upstreams")
+    parser.add_argument("--base-url", default=None, help="例: http://localhost:7071/api（省略時は同一プロセスで実行）")
+    parser.add_argument("--rps", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="秒")
+    parser.add_argument("--mix", default="shutuba=0.5,odds_refresh=0.3,process_past=0.2")
+    parser.add_argument("--races", type=int, default=6, help="アクセスが集中するレースの数")
+    parser.add_argument("--skew", action="store_true", help="一部のレースにアクセスを偏らせる")
+    parser.add_argument("--max-inflight", type=int, default=256)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    stub_servers.add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    races = race_ids(args.races)
+
+    netkeiba, openai = stub_servers.start_stub_servers(args)
+    env = stub_servers.stub_environment(netkeiba, openai)
+
+    if args.base_url:
+        print("ホスト側の環境変数（local.settings.json の Values）に以下を設定しておくこと:")
+        for k, v in env.items():
+            print(f"  {k}={v}")
+        target = HttpTarget(args.base_url)
+    else:
+        os.environ.update(env)
+        no_proxy = os.environ.get("NO_PROXY", "")
+        os.environ["NO_PROXY"] = ",".join(filter(None, [no_proxy, "127.0.0.1", "localhost"]))
+        # 前回の実行で溜まったキャッシュ・ストアを使わない
+        workdir = tempfile.mkdtemp(prefix="keiba-loadtest-")
+        os.environ.setdefault("HORSE_HISTORY_PATH", os.path.join(workdir, "horse_history.sqlite3"))
+        os.environ.setdefault("SUMMARY_CACHE_PATH", os.path.join(workdir, "summary_cache.sqlite3"))
+        target = InProcessTarget()
+
+    results, late = run_load(target, args, mix, races)
+    app_metrics = target.metrics()
+    report = {
+        "config": {
+            "rps": args.rps, "duration_s": args.duration, "mix": mix, "races": len(races),
+            "mode": "http" if args.base_url else "in-process",
+        },
+        "routes": results,
+        "late_sends": late,
+        "upstream_calls": netkeiba.counters.snapshot(),
+        "llm_calls": openai.counters.snapshot(),
+        "memory": app_metrics.get("memory", {}),
+        "single_flight": app_metrics.get("single_flight", {}),
+        "llm_scheduler": app_metrics.get("llm_scheduler", {}),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return 0
+
+    c = report["config"]
+    print(f"\n{c['mode']}  rps={c['rps']}  duration={c['duration_s']}s  races={c['races']}  mix={c['mix']}")
+    print(f"{'route':16} {'reqs':>6} {'ok':>6} {'req/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  statuses")
+    for route, r in results.items():
+        print(
+            f"{route:16} {r['requests']:>6} {r['ok']:>6} {r['throughput_rps']:>7} "
+            f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9}  {r['statuses']}"
+        )
+    if late:
+        print(f"\n予定より遅れて送ったリクエスト: {late}（負荷生成側が追いついていない）")
+    print(f"\nupstream: {report['upstream_calls']}")
+    print(f"llm:      {report['llm_calls']}")
+    print(f"memory:   {report['memory']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
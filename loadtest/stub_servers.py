@@ -0,0 +1,341 @@
+"""
+負荷試験用のスタブサーバー（netkeiba のページと Azure OpenAI の chat completions）
+
+    python loadtest/stub_servers.py --netkeiba-port 18080 --openai-port 18081
+
+単体でも起動できる（func start で動かしているホストに向ける場合など）。
+レスポンスは bench/fixtures の HTML を元に、レースごとに horse_id を変えて返す
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(os.path.dirname(HERE), "bench", "fixtures")
+
+SUMMARY = {
+    "strong": "平均着差が小さい",
+    "weak": "上がりが平凡",
+    "reason": "平均着差・ペース安定性が良好",
+    "suitability": "芝マイル向き",
+}
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+class Faults:
+    """
+    応答の遅延・エラー率・429 率（リクエストごとに乱数で決める）
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after_ms=1000, seed=None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        # (待ち時間, 'ok' / 'error' / 'rate_limited')
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            r = self.random.random()
+        if r < self.rate_limit_rate:
+            return delay, "rate_limited"
+        if r < self.rate_limit_rate + self.error_rate:
+            return delay, "error"
+        return delay, "ok"
+
+
+class Counters:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(sorted(self.values.items()))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def apply_faults(self, kind):
+        """
+        障害を注入したら True（レスポンス送信済み）
+        """
+        delay, outcome = self.server.faults.draw()
+        if delay:
+            time.sleep(delay)
+        if outcome == "rate_limited":
+            self.server.counters.incr(f"{kind}.429")
+            retry_after_ms = self.server.faults.retry_after_ms
+            self.send_body(
+                429,
+                json.dumps({"error": {"code": "429", "message": "Rate limit is exceeded."}}).encode(),
+                "application/json",
+                {"retry-after-ms": str(retry_after_ms), "Retry-After": str(max(1, retry_after_ms // 1000))},
+            )
+            return True
+        if outcome == "error":
+            self.server.counters.incr(f"{kind}.5xx")
+            self.send_body(503, b"stub error", "text/plain")
+            return True
+        return False
+
+
+# =========================================================
+# netkeiba
+# =========================================================
+ODDS_RE = re.compile(rb'(class="Odds_Ninki">)([\d.]+)(<)')
+
+
+class NetkeibaHandler(StubHandler):
+    def do_HEAD(self):
+        self.send_body(200, b"", "text/html")
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+
+        if parsed.path.startswith("/race/shutuba"):
+            kind = "shutuba"
+            body = self.server.shutuba_page(query.get("race_id", [""])[0])
+        elif parsed.path.startswith("/horse/ajax_horse_results"):
+            kind = "results"
+            body = self.server.pages["results"]
+        elif parsed.path.startswith("/horse/ped/"):
+            kind = "pedigree"
+            body = self.server.pages["pedigree"]
+        else:
+            self.server.counters.incr("other.404")
+            self.send_body(404, b"not found", "text/plain")
+            return
+
+        self.server.counters.incr(f"{kind}.requests")
+        if self.apply_faults(kind):
+            return
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.counters.incr(f"{kind}.304")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.server.counters.incr(f"{kind}.200")
+        self.server.counters.incr("bytes_sent", len(body))
+        self.send_body(200, body, "text/html; charset=EUC-JP", {"ETag": etag})
+
+
+class NetkeibaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults, odds_drift=0.0, seed=None):
+        super().__init__(address, NetkeibaHandler)
+        self.faults = faults
+        self.counters = Counters()
+        self.odds_drift = odds_drift
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {
+            "shutuba": load_fixture("shutuba_past.html"),
+            "results": load_fixture("ajax_horse_results.html"),
+            "pedigree": load_fixture("pedigree.html"),
+        }
+        self.race_pages = {}
+
+    def shutuba_page(self, race_id):
+        with self.lock:
+            page = self.race_pages.get(race_id)
+            if page is None:
+                # レースごとに別の馬にする（horse_id の先頭7桁をレースごとに変える）
+                prefix = str(2019100 + len(self.race_pages)).encode()
+                page = self.pages["shutuba"].replace(b"/horse/2019100", b"/horse/" + prefix)
+            elif self.odds_drift:
+                # 一部の馬のオッズを動かす（odds_refresh の差分確認用）
+                def drift(m):
+                    if self.random.random() >= self.odds_drift:
+                        return m.group(0)
+                    odds = max(1.0, float(m.group(2)) * self.random.uniform(0.8, 1.25))
+                    return m.group(1) + f"{odds:.1f}".encode() + m.group(3)
+
+                page = ODDS_RE.sub(drift, page)
+            self.race_pages[race_id] = page
+            return page
+
+
+# =========================================================
+# Azure OpenAI（chat completions）
+# =========================================================
+BATCH_LINE_RE = re.compile(r'^\{"horse_id": "(\w+)", "data"', re.M)
+
+
+class OpenAIHandler(StubHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+
+        if not urlparse(self.path).path.endswith("/chat/completions"):
+            self.send_body(404, b"{}", "application/json")
+            return
+
+        self.server.counters.incr("chat.requests")
+        if self.apply_faults("chat"):
+            return
+
+        try:
+            request = json.loads(raw)
+            prompt = request["messages"][-1]["content"]
+        except (ValueError, KeyError, IndexError):
+            self.send_body(400, b'{"error": {"message": "bad request"}}', "application/json")
+            return
+
+        # まとめ要約のプロンプトなら horse_id ごとの JSON を返す
+        horse_ids = BATCH_LINE_RE.findall(prompt)
+        if horse_ids:
+            self.server.counters.incr("chat.batch")
+            content = json.dumps({i: SUMMARY for i in horse_ids}, ensure_ascii=False)
+        else:
+            content = json.dumps(SUMMARY, ensure_ascii=False)
+
+        prompt_tokens = len(prompt) // 2
+        completion_tokens = len(content) // 2
+        self.server.counters.incr("chat.200")
+        self.server.counters.incr("chat.total_tokens", prompt_tokens + completion_tokens)
+
+        body = json.dumps({
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_body(200, body, "application/json")
+
+
+class OpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults):
+        super().__init__(address, OpenAIHandler)
+        self.faults = faults
+        self.counters = Counters()
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True)
+    thread.start()
+    return server
+
+
+def add_fault_arguments(parser):
+    parser.add_argument("--upstream-latency-ms", type=float, default=50.0)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    parser.add_argument("--upstream-429-rate", type=float, default=0.0)
+    parser.add_argument("--odds-drift", type=float, default=0.1, help="出馬表を返すたびにオッズが動く馬の割合")
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=400.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-429-rate", type=float, default=0.0)
+    parser.add_argument("--llm-retry-after-ms", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def start_stub_servers(args, netkeiba_port=0, openai_port=0):
+    netkeiba = start(NetkeibaServer(
+        ("127.0.0.1", netkeiba_port),
+        Faults(
+            args.upstream_latency_ms, args.upstream_jitter_ms,
+            args.upstream_error_rate, args.upstream_429_rate, seed=args.seed,
+        ),
+        odds_drift=args.odds_drift,
+        seed=args.seed,
+    ))
+    openai = start(OpenAIServer(
+        ("127.0.0.1", openai_port),
+        Faults(
+            args.llm_latency_ms, args.llm_jitter_ms,
+            args.llm_error_rate, args.llm_429_rate, args.llm_retry_after_ms, seed=args.seed + 1,
+        ),
+    ))
+    return netkeiba, openai
+
+
+def stub_environment(netkeiba, openai):
+    # function_app をスタブに向けるための環境変数
+    netkeiba_url = f"http://127.0.0.1:{netkeiba.server_address[1]}"
+    return {
+        "UPSTREAM_OVERRIDES": f"race.netkeiba.com={netkeiba_url},db.netkeiba.com={netkeiba_url}",
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{openai.server_address[1]}",
+        "AZURE_OPENAI_API_KEY": "loadtest",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="netkeiba / Azure OpenAI stub servers")
+    parser.add_argument("--netkeiba-port", type=int, default=18080)
+    parser.add_argument("--openai-port", type=int, default=18081)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    netkeiba, openai = start_stub_servers(args, args.netkeiba_port, args.openai_port)
+    print("function_app 側に設定する環境変数:")
+    for k, v in stub_environment(netkeiba, openai).items():
+        print(f"  {k}={v}")
+    print("Ctrl+C で終了（終了時に呼び出し回数を表示）")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(
+            {"netkeiba": netkeiba.counters.snapshot(), "openai": openai.counters.snapshot()},
+            indent=2, ensure_ascii=False,
+        ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
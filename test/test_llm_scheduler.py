@@ -0,0 +1,67 @@
+"""
+LLMScheduler の再試行と優先度（python -m pytest test）
+"""
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+os.environ.setdefault("SUMMARY_CACHE_BACKEND", "none")
+os.environ.setdefault("HORSE_HISTORY_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import function_app as fa  # noqa: E402
+
+
+class StubAPIError(Exception):
+    def __init__(self, status_code, retry_after_ms):
+        super().__init__(f"stub {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers={"retry-after-ms": str(retry_after_ms)})
+
+
+def failing_once(status_code, retry_after_ms, calls):
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise StubAPIError(status_code, retry_after_ms)
+        return "retried"
+    return fn
+
+
+class LLMSchedulerRetryTest(unittest.TestCase):
+    def make_scheduler(self):
+        return fa.LLMScheduler(rpm=100000, tpm=10 ** 9, concurrency=2, max_retries=2)
+
+    def test_5xx_retry_does_not_block_other_tasks(self):
+        scheduler = self.make_scheduler()
+        calls = []
+        start = time.monotonic()
+        retried = scheduler.submit("a", failing_once(503, 1000, calls), 1, priority=0)
+        time.sleep(0.2)
+        other = scheduler.submit("b", lambda: "ok", 1, priority=1)
+
+        self.assertEqual(other.result(timeout=5), "ok")
+        self.assertLess(time.monotonic() - start, 0.8)
+
+        self.assertEqual(retried.result(timeout=5), "retried")
+        self.assertGreaterEqual(calls[1] - calls[0], 0.95)
+        self.assertEqual(scheduler.stats()["retried"], 1)
+
+    def test_429_pauses_all_tasks(self):
+        scheduler = self.make_scheduler()
+        calls = []
+        start = time.monotonic()
+        limited = scheduler.submit("a", failing_once(429, 500, calls), 1, priority=0)
+        time.sleep(0.1)
+        other = scheduler.submit("b", lambda: "ok", 1, priority=1)
+
+        self.assertEqual(other.result(timeout=5), "ok")
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(limited.result(timeout=5), "retried")
+        self.assertEqual(scheduler.stats()["rate_limited"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()